@@ -1,23 +1,30 @@
-"""Command-Line Interface"""
+"""Command-Line Interface
+
+The heavy modules (GitPython, `monorepo_tools.import_into`) are only
+imported by the subcommands that use them, so that `--help`, `--version`
+and argument errors return quickly: see `cli_benchmark.py`.
+"""
 import re
 import os
-from git import Repo, SymbolicReference
-import gitdb
-import shutil
-import logging
 import argparse
+import collections
 import sys
-from monorepo_tools.import_into import import_into_monorepo, IndividualRepo
 
 VERSION = '0.0.1'
 
+#: Same as `monorepo_tools.import_into.ENGINES`, which is not imported
+#: before a subcommand runs.
+ENGINES = ['worktree', 'objects']
+
+
+def local_monorepo(monorepo_local_path, bare = False):
+  from git import Repo
 
-def local_monorepo(monorepo_local_path):
   if os.path.exists(monorepo_local_path):
     return Repo(monorepo_local_path)
 
   print("Monorepo does not exist. Create it from scratch...")
-  return Repo.init(monorepo_local_path, bare = False)
+  return Repo.init(monorepo_local_path, bare = bare)
 
 
 def load_source(name, path):
@@ -35,10 +42,93 @@ def load_source(name, path):
   return imp.load_source(name, path)
 
 
+def individual_repos(path, dest_branch_name):
+  """Loads the individual repos to import into a destination branch, either
+  from a JSON repos file, or from a python module that exports one
+  function, `individual_repos`, that takes the destination branch name as
+  an argument."""
+  from monorepo_tools.import_into import load_individual_repos
+
+  if path.endswith('.py'):
+    mod = load_source('individual_repos', path)
+    return mod.individual_repos(dest_branch_name)
+  return load_individual_repos(path, dest_branch_name)
+
+
+def parse_size(size):
+  """Parses a size in bytes, with an optional `K`, `M`, `G` or `T` suffix
+  (e.g., `10G`)."""
+  match = re.match(r"^\s*(\d+)\s*([KMGT]?)B?\s*$", size, re.IGNORECASE)
+  if not match:
+    raise argparse.ArgumentTypeError("invalid size '{}'".format(size))
+  return int(match.group(1)) * 1024**" KMGT".index(
+      match.group(2).upper() or " ")
+
+
+def write_metrics(metrics, path):
+  """Writes metrics as JSON to a file, or to stdout if `path` is `-`."""
+  if path == '-':
+    print(metrics.to_json())
+    return
+  with open(path, 'w') as f:
+    f.write(metrics.to_json())
+
+
+def check_import_options(options, parser):
+  """Checks the combinations of options of the `import` subcommand that are
+  invalid whatever the monorepo, before the monorepo is created."""
+  if options.bare and options.engine == 'worktree':
+    parser.error('--bare requires --engine objects')
+  if options.no_checkout and options.engine == 'worktree':
+    parser.error('--no_checkout requires --engine objects')
+
+
+def run_import(options, parser):
+  """Runs the `import` subcommand."""
+  from monorepo_tools.import_into import (import_into_monorepo_branches,
+                                          SyncError, ReposFileError)
+
+  repos = collections.OrderedDict()
+  try:
+    for dest_branch_name in options.dest_branch:
+      repos[dest_branch_name] = individual_repos(options.individual_repos,
+                                                 dest_branch_name)
+  except ReposFileError as e:
+    sys.exit(str(e))
+  monorepo = local_monorepo(options.monorepo_path, options.bare)
+  try:
+    metrics = import_into_monorepo_branches(
+        monorepo,
+        repos,
+        engine = options.engine,
+        checkout = not options.no_checkout,
+        jobs = options.jobs,
+        prune_remotes = options.prune_remotes,
+        mirror_cache_dir = options.mirror_cache,
+        mirror_cache_max_size = options.mirror_cache_max_size,
+        fetch_depth = options.fetch_depth,
+        fetch_filter = options.fetch_filter,
+        shallow_since = options.shallow_since)
+  except ValueError as e:
+    # The options are not valid for this monorepo (e.g., `--no_checkout`
+    # with the default engine of a monorepo that is not bare).
+    parser.error(str(e))
+  except SyncError as e:
+    if options.metrics_output:
+      write_metrics(e.metrics, options.metrics_output)
+    sys.exit(str(e))
+  if options.metrics_output:
+    write_metrics(metrics, options.metrics_output)
+
+
 def main():
   """Parses the command-line arguments."""
   parser = argparse.ArgumentParser(
       "monorepo_tools", description = 'Monorepo tools {}'.format(VERSION))
+  parser.add_argument(
+      '--version',
+      action = 'version',
+      version = '%(prog)s {}'.format(VERSION))
   subparsers = parser.add_subparsers(dest = 'subcommand')
 
   import_parser = subparsers.add_parser(
@@ -47,25 +137,96 @@ def main():
       '--individual_repos',
       required = True,
       help = (
-          'Path to python module that exports one function, individual_repos, '
-          + 'that takes the destination branch name as an argument'))
+          'Path to a JSON file that lists the individual repos (see '
+          + 'import_into/repos_file.py), or to a python module (.py) that '
+          + 'exports one function, individual_repos, that takes the '
+          + 'destination branch name as an argument'))
   import_parser.add_argument(
       '--dest_branch',
       required = True,
-      help = 'The destination branch to import into')
+      action = 'append',
+      help = (
+          'The destination branch to import into; repeat to import into '
+          + 'several destination branches in one pass (the first one is '
+          + 'checked out)'))
   import_parser.add_argument(
       '--monorepo_path',
       required = True,
       help =
       'The local path to the monorepo (it is created if it does not exist)')
+  import_parser.add_argument(
+      '--bare',
+      action = 'store_true',
+      help = (
+          'Create the monorepo as a bare repo if it does not exist (the '
+          + 'import into a bare monorepo never writes a working tree)'))
+  import_parser.add_argument(
+      '--engine',
+      choices = ENGINES,
+      help = (
+          'The engine to use to create the individual repo branches: '
+          + '"worktree" moves the files in the working tree, "objects" '
+          + 'writes the moved and merged trees directly in the object '
+          + 'database (default: "worktree", or "objects" for a bare '
+          + 'monorepo)'))
+  import_parser.add_argument(
+      '--no_checkout',
+      action = 'store_true',
+      help = (
+          'Do not check out the destination branch at the end of the import '
+          + '(only with --engine objects)'))
+  import_parser.add_argument(
+      '--jobs',
+      type = int,
+      default = 1,
+      help = 'The maximum number of individual repos to fetch concurrently')
+  import_parser.add_argument(
+      '--prune_remotes',
+      action = 'store_true',
+      help = (
+          'Delete the remotes of the individual repos that were previously '
+          + 'imported into the destination branch but are not imported '
+          + 'anymore'))
+  import_parser.add_argument(
+      '--mirror_cache',
+      help = (
+          'Directory of bare mirrors of the individual repos, shared between '
+          + 'monorepos, to fetch from (it is created if it does not exist)'))
+  import_parser.add_argument(
+      '--mirror_cache_max_size',
+      type = parse_size,
+      help = (
+          'Maximum size of the mirror cache (e.g., 10G); the least recently '
+          + 'used mirrors are deleted first'))
+  import_parser.add_argument(
+      '--fetch_depth',
+      type = int,
+      help = (
+          'Fetch only this number of commits from the tip of the individual '
+          + 'repo branches (the monorepo becomes shallow)'))
+  import_parser.add_argument(
+      '--fetch_filter',
+      help = (
+          'Filter of the objects to fetch from the individual repos, for a '
+          + 'partial clone (e.g., blob:none)'))
+  import_parser.add_argument(
+      '--shallow_since',
+      help = (
+          'Fetch only the history of the individual repo branches since '
+          + 'this date (the monorepo becomes shallow)'))
+  import_parser.add_argument(
+      '--metrics_output',
+      help = (
+          'Where to write the duration of each phase and the counters of '
+          + 'the import, as JSON ("-" for stdout)'))
 
   options = parser.parse_args()
 
   if options.subcommand == 'import':
-    mod = load_source('individual_repos', options.individual_repos)
-    repos = mod.individual_repos(options.dest_branch)
-    monorepo = local_monorepo(options.monorepo_path)
-    import_into_monorepo(monorepo, repos, options.dest_branch)
+    check_import_options(options, import_parser)
+    run_import(options, import_parser)
+  elif options.subcommand is None:
+    parser.error('a subcommand is required')
   else:
     raise Exception("unexpected subcommand {}".format(options.subcommand))
 
@@ -0,0 +1,93 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the startup time of the CLI.
+
+The CLI, either `cli.py` or the runnable ZIP file, is run several times for
+each case (e.g., `--help`), and the startup times are given as JSON, in
+milliseconds:
+
+```
+bazel build //:monorepo_tools --build_python_zip
+bazel run //:cli_benchmark -- --cli $PWD/bazel-bin/monorepo_tools.zip
+```
+"""
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+#: Name and arguments of each case.
+CASES = [
+    ("help", ["--help"]),
+    ("version", ["--version"]),
+    ("import_help", ["import", "--help"]),
+    ("invalid_arguments", ["import"]),
+]
+
+
+def run_benchmark(cli, runs = 20):
+  """Times the startup of the CLI.
+
+  Args:
+    cli: The path to `cli.py` or to the runnable ZIP file.
+    runs: The number of times each case is run.
+  Returns:
+    A list of results, one for each case, with the minimum, median and
+    maximum startup times, in milliseconds.
+  """
+  results = []
+  with open(os.devnull, "w") as devnull:
+    for (name, args) in CASES:
+      durations = []
+      for _ in range(runs):
+        start = timeit.default_timer()
+        # The invalid arguments exit with a non-zero status.
+        subprocess.call([sys.executable, cli] + args,
+                        stdout = devnull,
+                        stderr = devnull)
+        durations.append((timeit.default_timer() - start) * 1000)
+      durations.sort()
+      results.append(
+          collections.OrderedDict([
+              ("case", name),
+              ("args", args),
+              ("min", durations[0]),
+              ("median", durations[len(durations) // 2]),
+              ("max", durations[-1]),
+          ]))
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      "cli_benchmark", description = "Benchmark of the CLI startup time")
+  parser.add_argument(
+      "--cli",
+      default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "cli.py"),
+      help = "The path to cli.py or to the runnable ZIP file")
+  parser.add_argument(
+      "--runs",
+      type = int,
+      default = 20,
+      help = "The number of times each case is run")
+  parser.add_argument(
+      "--output", help = "Where to write the results (default: stdout)")
+  options = parser.parse_args()
+
+  results = run_benchmark(options.cli, options.runs)
+  output = json.dumps(results, indent = 2)
+  if options.output:
+    with open(options.output, "w") as f:
+      f.write(output)
+  else:
+    print(output)
+
+
+if __name__ == "__main__":
+  main()
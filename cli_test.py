@@ -0,0 +1,86 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Unit tests for the CLI."""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import cli
+from monorepo_tools.common.pathutils import onerror
+from monorepo_tools.import_into import ENGINES
+
+#: Prints the heavy modules imported when the CLI runs with some arguments.
+_LIST_HEAVY_MODULES = """
+import sys
+sys.argv = ["monorepo_tools"] + sys.argv[1:]
+import cli
+try:
+  cli.main()
+except SystemExit:
+  pass
+sys.stderr.write("\\nheavy modules:" + " ".join(sorted(
+    name for name in sys.modules
+    if name.split(".")[0] in ("git", "gitdb", "monorepo_tools"))))
+"""
+
+
+class CliTest(unittest.TestCase):
+
+  def test_engines(self):
+    self.assertEqual(cli.ENGINES, ENGINES)
+
+  def test_heavy_modules_are_imported_lazily(self):
+    for args in [["--help"], ["--version"], ["import", "--help"], ["import"]]:
+      process = subprocess.Popen(
+          [sys.executable, "-c", _LIST_HEAVY_MODULES] + args,
+          cwd = os.path.dirname(os.path.abspath(cli.__file__)),
+          stdout = subprocess.PIPE,
+          stderr = subprocess.PIPE)
+      (_, stderr) = process.communicate()
+      # The last line is written once the CLI has run.
+      self.assertEqual(stderr.decode("utf-8").splitlines()[-1],
+                       "heavy modules:", args)
+
+  def test_invalid_import_options_are_usage_errors(self):
+    workdir = tempfile.mkdtemp()
+    repos_file = os.path.join(workdir, "individual_repos.json")
+    with open(repos_file, "w") as f:
+      json.dump({
+          "version": 1,
+          "individual_repos": [{
+              "location": os.path.join(workdir, "repo"),
+              "branch": "master"
+          }]
+      }, f)
+    try:
+      for (args, message) in [
+          (["--bare", "--engine", "worktree"],
+           "--bare requires --engine objects"),
+          (["--no_checkout", "--engine", "worktree"],
+           "--no_checkout requires --engine objects"),
+          # Only known once the monorepo is opened
+          (["--no_checkout"], "only the 'objects' engine can skip"),
+      ]:
+        process = subprocess.Popen(
+            [
+                sys.executable, "cli.py", "import", "--individual_repos",
+                repos_file, "--dest_branch", "master", "--monorepo_path",
+                os.path.join(workdir, "monorepo")
+            ] + args,
+            cwd = os.path.dirname(os.path.abspath(cli.__file__)),
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE)
+        (_, stderr) = process.communicate()
+        self.assertEqual(process.returncode, 2, args)
+        self.assertIn("error: " + message, stderr.decode("utf-8"), args)
+    finally:
+      shutil.rmtree(workdir, onerror = onerror)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,35 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from multiprocessing.pool import ThreadPool
+
+
+def map_in_pool(fun, items, jobs):
+  """Calls a function on each item, with at most `jobs` calls running
+  concurrently on a pool of threads.
+
+  An exception raised by one call does not abort the other calls: it is
+  returned instead.
+
+  Returns:
+    A list of `(result, exception)` pairs, in the same order as `items`.
+    In each pair, either `result` or `exception` is `None`.
+  """
+  items = list(items)
+
+  def call(item):
+    try:
+      return (fun(item), None)
+    except Exception as e:
+      return (None, e)
+
+  if jobs <= 1 or len(items) <= 1:
+    return [call(item) for item in items]
+  pool = ThreadPool(min(jobs, len(items)))
+  try:
+    return pool.map(call, items)
+  finally:
+    pool.close()
+    pool.join()
@@ -4,7 +4,14 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import shutil
 import stat
+import sys
+
+#: `ioctl` request to share the data blocks of a file with another file, on
+#: copy-on-write file systems (e.g., Btrfs, XFS), from `linux/fs.h`.
+_FICLONE = 0x40049409
+_CHUNK_SIZE = 1024 * 1024
 
 
 def onerror(func, path, exc_info):
@@ -23,3 +30,93 @@ def onerror(func, path, exc_info):
     func(path)
   else:
     raise
+
+
+def copytree(src, dst, copy_function = shutil.copy2, ignore = None):
+  """Same as `shutil.copytree(src, dst, symlinks=True, ignore=ignore,
+  copy_function=copy_function)`, which does not take a `copy_function` on
+  Python 2."""
+  if sys.version_info >= (3, 0):
+    return shutil.copytree(
+        src,
+        dst,
+        symlinks = True,
+        ignore = ignore,
+        copy_function = copy_function)
+  names = os.listdir(src)
+  ignored = ignore(src, names) if ignore else set()
+  os.makedirs(dst)
+  for name in names:
+    if name in ignored:
+      continue
+    src_name = os.path.join(src, name)
+    dst_name = os.path.join(dst, name)
+    if os.path.islink(src_name):
+      os.symlink(os.readlink(src_name), dst_name)
+    elif os.path.isdir(src_name):
+      copytree(src_name, dst_name, copy_function, ignore)
+    else:
+      copy_function(src_name, dst_name)
+  shutil.copystat(src, dst)
+  return dst
+
+
+def hardlink_or_copy(src, dst):
+  """Hard links a file, or copies it if it cannot be hard linked (e.g.,
+  across file systems).
+
+  Usage: `copytree(src, dst, copy_function=hardlink_or_copy)`
+  """
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst)
+  return dst
+
+
+def reflink_or_copy(src, dst):
+  """Copies a file, sharing its data blocks with the source on
+  copy-on-write file systems, or letting the kernel copy them with
+  `copy_file_range` where supported.  The data goes through user space
+  only as a last resort.
+
+  Usage: `copytree(src, dst, copy_function=reflink_or_copy)`
+  """
+  try:
+    import fcntl
+  except ImportError:
+    # Not a POSIX system
+    return shutil.copy2(src, dst)
+  with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+    try:
+      fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+      _copy_file_range(fsrc, fdst)
+  shutil.copystat(src, dst)
+  return dst
+
+
+def _copy_file_range(fsrc, fdst):
+  if hasattr(os, "copy_file_range"):
+    try:
+      while os.copy_file_range(fsrc.fileno(), fdst.fileno(), _CHUNK_SIZE):
+        pass
+      return
+    except OSError:
+      # Not supported between these file systems: the copy continues from
+      # the current offsets.
+      pass
+  shutil.copyfileobj(fsrc, fdst, _CHUNK_SIZE)
+
+
+def rename_or_copy(src, dst):
+  """Renames a file, or copies it if it cannot be renamed (e.g., across
+  file systems).  The source file is gone if the rename succeeds.
+
+  Usage: `copytree(src, dst, copy_function=rename_or_copy)`
+  """
+  try:
+    os.rename(src, dst)
+  except OSError:
+    shutil.copy2(src, dst)
+  return dst
@@ -3,6 +3,23 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from .import_into import import_into_monorepo, IndividualRepo
+import sys
 
-__all__ = ["import_into_monorepo", "IndividualRepo"]
+from .import_into import (import_into_monorepo, import_into_monorepo_branches,
+                          IndividualRepo, SyncError, InitialCommitError,
+                          ENGINE_WORKTREE, ENGINE_OBJECTS, ENGINES)
+from .manifest import read_manifest
+from .repos_file import load_individual_repos, ReposFileError
+
+__all__ = [
+    "import_into_monorepo", "import_into_monorepo_branches", "IndividualRepo",
+    "SyncError", "InitialCommitError", "ENGINE_WORKTREE", "ENGINE_OBJECTS",
+    "ENGINES", "read_manifest", "load_individual_repos", "ReposFileError"
+]
+
+if sys.version_info >= (3, 5):
+  from .import_into_async import (import_into_monorepo_async,
+                                  import_into_monorepo_branches_async)
+  __all__ += [
+      "import_into_monorepo_async", "import_into_monorepo_branches_async"
+  ]
@@ -0,0 +1,233 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Offline benchmark of the import algorithms on synthetic individual
+repos.
+
+Each phase of each algorithm is timed, and counted, for an initial import,
+a no-op re-import and an incremental import, and the results are given as
+JSON:
+
+```
+bazel run //import_into:benchmark -- --repos 10 --files 10000 --depth 4
+```
+"""
+import argparse
+import collections
+import json
+import os
+import shutil
+import tempfile
+from git import Repo
+from monorepo_tools.common.pathutils import onerror
+from monorepo_tools.import_into import (import_into_monorepo, IndividualRepo,
+                                        ENGINES)
+from single_commit import (single_commit, BACKENDS, COPY_STRATEGIES,
+                           COPY_STRATEGY_COPY)
+from testutils import init_synthetic_repo, add_synthetic_commit
+
+ALGORITHMS = ["import_into_monorepo", "single_commit"]
+DEST_BRANCH_NAME = "benchmark"
+LOGGER_NAME = "monorepo-benchmark"
+
+
+def run_benchmark(workdir,
+                  repos = 5,
+                  files = 1000,
+                  depth = 3,
+                  commits = 10,
+                  side_branches = 0,
+                  jobs = 1,
+                  algorithms = ALGORITHMS,
+                  engines = ENGINES,
+                  backends = BACKENDS,
+                  copy_strategy = COPY_STRATEGY_COPY):
+  """Runs the benchmark.
+
+  Args:
+    workdir: The directory where to create the synthetic individual repos
+      and the monorepos.  It must be empty or not exist.
+    repos: The number of synthetic individual repos.
+    files, depth, commits, side_branches: The shape of each synthetic
+      individual repo (see `testutils.init_synthetic_repo`).
+    jobs: The maximum number of individual repos to fetch, or clone and
+      copy, concurrently.
+    algorithms: The algorithms to benchmark, among `ALGORITHMS`.
+    engines: The engines of `import_into_monorepo` to benchmark.
+    backends: The backends of `single_commit` to benchmark.
+    copy_strategy: The copy strategy of `single_commit`.
+  Returns:
+    A list of results, one for each algorithm, engine (or backend) and
+    scenario.  Each
+    result is a dictionary with the metrics of the import (see
+    `metrics.Metrics.to_dict`).
+  """
+  individual_repos = []
+  for i in range(repos):
+    name = "repo{}".format(i)
+    repo = init_synthetic_repo(
+        os.path.join(workdir, "individual_repos", name),
+        "master",
+        files = files,
+        depth = depth,
+        commits = commits,
+        side_branches = side_branches,
+        seed = i)
+    individual_repos.append(
+        IndividualRepo(
+            repo.git_dir,
+            "master",
+            name = name,
+            destination = "packages/{}".format(name)))
+
+  results = []
+  if "single_commit" in algorithms:
+    for backend in backends:
+      monorepo = Repo.init(
+          os.path.join(workdir, "monorepo_single_commit_" + backend))
+      clones_dir = os.path.join(workdir, "clones_" + backend)
+      os.mkdir(clones_dir)
+      results.append(
+          _result(
+              "single_commit", backend, "initial",
+              single_commit(
+                  monorepo,
+                  individual_repos,
+                  DEST_BRANCH_NAME,
+                  workdir = clones_dir,
+                  silent = True,
+                  logger_name = LOGGER_NAME,
+                  backend = backend,
+                  jobs = jobs,
+                  copy_strategy = copy_strategy)))
+  if "import_into_monorepo" in algorithms:
+    monorepos = {
+        engine: Repo.init(os.path.join(workdir, "monorepo_" + engine))
+        for engine in engines
+    }
+    for scenario in ["initial", "noop", "incremental"]:
+      if scenario == "incremental":
+        for individual_repo in individual_repos:
+          add_synthetic_commit(
+              Repo(individual_repo.location), "master", files = 10)
+      for engine in engines:
+        results.append(
+            _result(
+                "import_into_monorepo", engine, scenario,
+                import_into_monorepo(
+                    monorepos[engine],
+                    individual_repos,
+                    DEST_BRANCH_NAME,
+                    silent = True,
+                    logger_name = LOGGER_NAME,
+                    engine = engine,
+                    jobs = jobs)))
+  return results
+
+
+def _result(algorithm, engine, scenario, metrics):
+  result = collections.OrderedDict([
+      ("algorithm", algorithm),
+      ("engine", engine),
+      ("scenario", scenario),
+  ])
+  result.update(metrics.to_dict())
+  result["total"] = sum(metrics.phases.values())
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      "benchmark", description = "Benchmark of the import algorithms")
+  parser.add_argument(
+      "--repos",
+      type = int,
+      default = 5,
+      help = "The number of individual repos")
+  parser.add_argument(
+      "--files",
+      type = int,
+      default = 1000,
+      help = "The number of files in each individual repo")
+  parser.add_argument(
+      "--depth",
+      type = int,
+      default = 3,
+      help = "The directory depth of the files")
+  parser.add_argument(
+      "--commits",
+      type = int,
+      default = 10,
+      help = "The number of commits in each individual repo")
+  parser.add_argument(
+      "--side_branches",
+      type = int,
+      default = 0,
+      help = "The number of merged side branches in each individual repo")
+  parser.add_argument(
+      "--jobs",
+      type = int,
+      default = 1,
+      help = (
+          "The maximum number of individual repos to fetch, or clone and "
+          + "copy, concurrently"))
+  parser.add_argument(
+      "--algorithm",
+      action = "append",
+      choices = ALGORITHMS,
+      help = "An algorithm to benchmark (default: all)")
+  parser.add_argument(
+      "--engine",
+      action = "append",
+      choices = ENGINES,
+      help = "An engine of import_into_monorepo to benchmark (default: all)")
+  parser.add_argument(
+      "--backend",
+      action = "append",
+      choices = BACKENDS,
+      help = "A backend of single_commit to benchmark (default: all)")
+  parser.add_argument(
+      "--copy_strategy",
+      choices = COPY_STRATEGIES,
+      default = COPY_STRATEGY_COPY,
+      help = "The copy strategy of single_commit")
+  parser.add_argument(
+      "--workdir",
+      help = (
+          "Where to put the repos (default: a temporary directory that is "
+          + "deleted afterwards)"))
+  parser.add_argument(
+      "--output", help = "Where to write the results (default: stdout)")
+  options = parser.parse_args()
+
+  workdir = options.workdir or tempfile.mkdtemp(prefix = "monorepo-benchmark")
+  try:
+    results = run_benchmark(
+        workdir,
+        repos = options.repos,
+        files = options.files,
+        depth = options.depth,
+        commits = options.commits,
+        side_branches = options.side_branches,
+        jobs = options.jobs,
+        algorithms = options.algorithm or ALGORITHMS,
+        engines = options.engine or ENGINES,
+        backends = options.backend or BACKENDS,
+        copy_strategy = options.copy_strategy)
+  finally:
+    if not options.workdir:
+      shutil.rmtree(workdir, onerror = onerror)
+  output = json.dumps(
+      collections.OrderedDict([("parameters", vars(options)),
+                               ("results", results)]),
+      indent = 2)
+  if options.output:
+    with open(options.output, "w") as f:
+      f.write(output)
+  else:
+    print(output)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,44 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Smoke tests for the benchmark."""
+import os
+import shutil
+import unittest
+from monorepo_tools.common.pathutils import onerror
+from monorepo_tools.import_into import ENGINES
+from benchmark import run_benchmark
+from single_commit import BACKENDS
+from testutils import REPOS_ROOT
+
+
+class BenchmarkTest(unittest.TestCase):
+
+  def setUp(self):
+    if os.path.exists(REPOS_ROOT):
+      shutil.rmtree(REPOS_ROOT, onerror = onerror)
+    os.mkdir(REPOS_ROOT)
+
+  def test_all_the_phases_are_timed(self):
+    results = run_benchmark(
+        os.path.join(REPOS_ROOT, "benchmark"),
+        repos = 2,
+        files = 20,
+        depth = 2,
+        commits = 4,
+        side_branches = 1)
+    self.assertEqual(
+        [(result["algorithm"], result["engine"], result["scenario"])
+         for result in results],
+        [("single_commit", backend, "initial") for backend in BACKENDS] +
+        [("import_into_monorepo", engine, scenario)
+         for scenario in ["initial", "noop", "incremental"]
+         for engine in ENGINES])
+    for result in results:
+      self.assertTrue(result["phases"])
+      self.assertAlmostEqual(result["total"], sum(result["phases"].values()))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -15,7 +15,7 @@ from rules_python.python.runfiles import runfiles
 from git import Repo
 from monorepo_tools.import_into import import_into_monorepo
 from monorepo_tools.common.pathutils import onerror
-from single_commit import single_commit
+from single_commit import single_commit, BACKEND_FAST_IMPORT
 from individual_repos import individual_repos
 
 REPOS_ROOT = os.path.join(os.environ["TEST_TMPDIR"], "REPOS")
@@ -36,6 +36,13 @@ ALGORITHMS = [
         name = "single_commit",
         fun = single_commit,
         options = {"workdir": os.path.join(REPOS_ROOT, "workdir")}),
+    Algorithm(
+        name = "single_commit_fast_import",
+        fun = single_commit,
+        options = {
+            "workdir": os.path.join(REPOS_ROOT, "workdir_fast_import"),
+            "backend": BACKEND_FAST_IMPORT,
+        }),
 ]
 
 
@@ -0,0 +1,37 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Backend for the Git objects read and written during an import.
+
+The objects are read through long-lived `git cat-file --batch` and
+`git cat-file --batch-check` processes, that GitPython keeps open for as
+long as the `git.Git` command wrapper lives.  The objects are written in
+process, as loose objects, instead of spawning one `git hash-object` per
+object as some versions of GitPython do: moves, merges, commits and
+manifests then write objects without spawning any git process.
+"""
+import contextlib
+from git.db import GitCmdObjectDB
+from gitdb.db import LooseObjectDB
+
+
+class ObjectDB(GitCmdObjectDB):
+  """Object database that reads objects through `git cat-file` and writes
+  them in process."""
+
+  def store(self, istream):
+    return LooseObjectDB.store(self, istream)
+
+
+@contextlib.contextmanager
+def git_backend(repo):
+  """Context manager that makes the object database of a repo an
+  `ObjectDB` that shares the long-lived `git cat-file` processes of
+  `repo.git`."""
+  original_odb = repo.odb
+  repo.odb = ObjectDB(original_odb.root_path(), repo.git)
+  try:
+    yield
+  finally:
+    repo.odb = original_odb
@@ -0,0 +1,45 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Unit tests for the `git_backend` module."""
+import os
+import shutil
+import unittest
+from io import BytesIO
+from git import Repo
+from gitdb.base import IStream
+from gitdb.util import bin_to_hex
+from monorepo_tools.common.pathutils import onerror
+from monorepo_tools.import_into.git_backend import git_backend
+from monorepo_tools.import_into.metrics import (Metrics, count_git_processes,
+                                                GIT_PROCESSES)
+from testutils import REPOS_ROOT
+
+
+class GitBackendTest(unittest.TestCase):
+
+  def setUp(self):
+    if os.path.exists(REPOS_ROOT):
+      shutil.rmtree(REPOS_ROOT, onerror = onerror)
+    os.mkdir(REPOS_ROOT)
+
+  def test_objects_are_written_in_process(self):
+    repo = Repo.init(os.path.join(REPOS_ROOT, "repo"))
+    odb = repo.odb
+    metrics = Metrics()
+    with count_git_processes(repo, metrics), git_backend(repo):
+      binsha = repo.odb.store(IStream("blob", 3, BytesIO(b"FOO"))).binsha
+      self.assertEqual(repo.odb.stream(binsha).read(), b"FOO")
+      # The same long-lived `git cat-file` processes serve all the reads.
+      repo.odb.info(binsha)
+      repo.odb.stream(binsha).read()
+    self.assertEqual(metrics.counters[GIT_PROCESSES], 2)
+    self.assertIs(repo.odb, odb)
+    self.assertEqual(
+        repo.git.cat_file("-p",
+                          bin_to_hex(binsha).decode("ascii")), "FOO")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,20 +1,45 @@
 """Imports individual repos into a monorepo using a "merge unrelated histories
 and move" strategy."""
+import collections
+import copy
 import logging
 import os
+import posixpath
 # Copyright (c) Hadrien Chauvin
 #
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from git import Actor
+from git import Actor, Reference, SymbolicReference
+from git.index.typ import IndexEntry
+from git.objects import Commit, Tree
 import shutil
+from monorepo_tools.common.concurrency import map_in_pool
+from monorepo_tools.import_into.git_backend import git_backend
+from monorepo_tools.import_into.manifest import (MANIFEST_VERSION,
+                                                 read_manifest, write_manifest)
+from monorepo_tools.import_into.metrics import (Metrics, count_git_processes,
+                                                FILES_MOVED, MERGES)
+from monorepo_tools.import_into.mirror_cache import MirrorCache
+from monorepo_tools.import_into.trees import (write_tree, nest_tree,
+                                              splice_tree, subtree_at)
 
 DEFAULT_LOGGER_NAME = "monorepo"
 DEFAULT_AUTHOR = Actor("monorepo-tools", "monorepo-tools@chauvin.io")
 DEFAULT_COMMITTER = DEFAULT_AUTHOR
 INITIAL_COMMIT_MESSAGE = "Initial monorepo commit"
 
+#: Engine that checks out the individual repo branches and moves the files
+#: in the working tree.
+ENGINE_WORKTREE = "worktree"
+#: Engine that writes the moved and merged trees directly in the object
+#: database, without ever checking out an individual repo branch.
+ENGINE_OBJECTS = "objects"
+ENGINES = [ENGINE_WORKTREE, ENGINE_OBJECTS]
+
+#: Prefix of the individual repo branches of all the destination branches.
+_INDIVIDUAL_REPO_BRANCH_PREFIX = "individual_repos/"
+
 
 def import_into_monorepo(monorepo,
                          individual_repos,
@@ -22,27 +47,257 @@ def import_into_monorepo(monorepo,
                          silent = False,
                          author = DEFAULT_AUTHOR,
                          committer = DEFAULT_COMMITTER,
-                         logger_name = DEFAULT_LOGGER_NAME):
+                         logger_name = DEFAULT_LOGGER_NAME,
+                         engine = None,
+                         checkout = True,
+                         jobs = 1,
+                         prune_remotes = False,
+                         mirror_cache_dir = None,
+                         mirror_cache_max_size = None,
+                         fetch_depth = None,
+                         fetch_filter = None,
+                         shallow_since = None):
   """Imports individual repos into a monorepo using a "merge unrelated histories
   and move" strategy.
 
   Args:
-    monorepo: Monorepo object, of type `git.Repo`, to import into.
+    monorepo: Monorepo object, of type `git.Repo`, to import into.  It can
+      be bare, in which case the import never writes a working tree.
     individual_repos: List of individual repos, of type `IndividualRepo`.
     dest_branch_name: The destination branch to put the individual repos in.
     silent: Whether to suppress all progress report.
     author: The author to use when the import algorithm creates commits.
     committer: The committer to use when the import algorithm creates commits.
     logger_name: The `logging` logger name to use for all progress reports.
+    engine: The engine to use to create or update the individual repo
+      branches and merge them, one of `ENGINES`.  With `ENGINE_OBJECTS`,
+      the files are moved by nesting the tree of the individual repo under
+      its destination, and merged by splicing this tree into the tree of
+      the destination branch: the cost is proportional to the depth of the
+      destination folder instead of the number of files.  By default,
+      `ENGINE_WORKTREE`, or `ENGINE_OBJECTS` for a bare monorepo, which
+      only `ENGINE_OBJECTS` supports.
+    checkout: Whether to check out the destination branch in the working
+      tree at the end of the import.  Only `ENGINE_OBJECTS` can skip the
+      checkout.  A bare monorepo is never checked out.
+    jobs: The maximum number of individual repos to fetch concurrently.
+      Shallow fetches, which all update `.git/shallow`, and everything
+      else are done serially.
+    prune_remotes: Whether to delete the stale remotes, i.e., the remotes
+      of individual repos that were previously imported into
+      `dest_branch_name` but are not in `individual_repos` anymore.  The
+      remotes are shared by all the destination branches, and are kept
+      while another destination branch has an individual repo branch for
+      them.
+    mirror_cache_dir: Optional directory of bare mirrors of the individual
+      repos, which can be shared by many monorepos.  The mirrors are updated
+      from the individual repo locations, then the monorepo fetches from
+      the mirrors.
+    mirror_cache_max_size: Optional maximum size, in bytes, of the mirror
+      cache.  The least recently used mirrors are deleted when the cache
+      is bigger.
+    fetch_depth, fetch_filter, shallow_since: Defaults for the individual
+      repos that do not set these options (see `IndividualRepo`).
+
+  The individual repos imported into `dest_branch_name`, and the upstream
+  commits they were imported from, are recorded in a manifest (see
+  `manifest.read_manifest`).  The manifest tells in constant time whether
+  an individual repo changed since the last import.
+  Returns:
+    The metrics of the import, of type `metrics.Metrics`: the duration of
+    each phase and counters, globally and for each individual repo.
+  Raises:
+    SyncError: Some individual repos could not be fetched.  The other
+      individual repos are still imported.
+  """
+  return import_into_monorepo_branches(
+      monorepo,
+      collections.OrderedDict([(dest_branch_name, individual_repos)]),
+      silent = silent,
+      author = author,
+      committer = committer,
+      logger_name = logger_name,
+      engine = engine,
+      checkout = checkout,
+      jobs = jobs,
+      prune_remotes = prune_remotes,
+      mirror_cache_dir = mirror_cache_dir,
+      mirror_cache_max_size = mirror_cache_max_size,
+      fetch_depth = fetch_depth,
+      fetch_filter = fetch_filter,
+      shallow_since = shallow_since)
+
+
+def import_into_monorepo_branches(monorepo,
+                                  individual_repos_by_branch,
+                                  silent = False,
+                                  author = DEFAULT_AUTHOR,
+                                  committer = DEFAULT_COMMITTER,
+                                  logger_name = DEFAULT_LOGGER_NAME,
+                                  engine = None,
+                                  checkout = True,
+                                  jobs = 1,
+                                  prune_remotes = False,
+                                  mirror_cache_dir = None,
+                                  mirror_cache_max_size = None,
+                                  fetch_depth = None,
+                                  fetch_filter = None,
+                                  shallow_since = None):
+  """Same as `import_into_monorepo`, for several destination branches in
+  one pass.
+
+  Each upstream branch is fetched once, even if it is imported into several
+  destination branches, and the individual repo branches of the
+  destination branches that are created together share their commits.
+  Only the merges are done for each destination branch.
+
+  Args:
+    individual_repos_by_branch: Ordered mapping (e.g., a
+      `collections.OrderedDict`) of the destination branch names to the
+      list of individual repos, of type `IndividualRepo`, to import into
+      them.  An individual repo that is imported into several destination
+      branches must have the same location in all of them.  The first
+      destination branch is the one that is checked out at the end of the
+      import.
+    For the other arguments, see `import_into_monorepo`.
+  Returns:
+    The metrics of the import, of type `metrics.Metrics`, for all the
+    destination branches.
+  Raises:
+    SyncError: Some individual repos could not be fetched.  The other
+      individual repos are still imported.
   """
-  syncer = _MonorepoSyncer(monorepo, individual_repos, author, committer,
-                           logger_name)
+  (engine, checkout) = _check_options(monorepo, individual_repos_by_branch,
+                                      engine, checkout)
+  syncer = _new_syncer(monorepo, individual_repos_by_branch, silent, author,
+                       committer, logger_name, engine, mirror_cache_dir,
+                       mirror_cache_max_size)
+  metrics = syncer.metrics
+  with count_git_processes(monorepo, metrics), git_backend(monorepo):
+    with metrics.phase("create_remotes"):
+      syncer.create_remotes(individual_repos_by_branch.keys(), prune_remotes)
+    with metrics.phase("fetch"):
+      syncer.fetch_individual_repos(jobs, fetch_depth, fetch_filter,
+                                    shallow_since)
+    _import_fetched(syncer, individual_repos_by_branch, checkout)
+  if syncer.errors:
+    raise SyncError(syncer.errors, metrics)
+  syncer.logger.info("Done")
+  return metrics
+
+
+def _check_options(monorepo, individual_repos_by_branch, engine, checkout):
+  """Checks the options of an import.
+
+  Returns:
+    The `(engine, checkout)` pair to use for the import.
+  Raises:
+    ValueError: The options are not valid.
+  """
+  if monorepo.bare:
+    engine = engine or ENGINE_OBJECTS
+    if engine != ENGINE_OBJECTS:
+      raise ValueError("only the '{}' engine can import into a bare repo"
+                       .format(ENGINE_OBJECTS))
+    checkout = False
+  engine = engine or ENGINE_WORKTREE
+  if engine not in ENGINES:
+    raise ValueError("unknown engine '{}'; expected one of {}".format(
+        engine, ENGINES))
+  if not checkout and engine != ENGINE_OBJECTS:
+    raise ValueError("only the '{}' engine can skip the checkout".format(
+        ENGINE_OBJECTS))
+  if not individual_repos_by_branch:
+    raise ValueError("no destination branch")
+  return (engine, checkout)
+
+
+def _new_syncer(monorepo, individual_repos_by_branch, silent, author,
+                committer, logger_name, engine, mirror_cache_dir,
+                mirror_cache_max_size):
+  mirror_cache = None
+  if mirror_cache_dir:
+    mirror_cache = MirrorCache(mirror_cache_dir, mirror_cache_max_size)
+  syncer = _MonorepoSyncer(monorepo,
+                           _upstream_branches(individual_repos_by_branch),
+                           author, committer, logger_name, engine,
+                           mirror_cache)
   if silent:
     syncer.logger.setLevel(logging.WARNING)
-  syncer.create_remotes()
-  to_update = syncer.create_or_update_individual_repo_branches(dest_branch_name)
-  syncer.merge_individual_repo_branches(to_update, dest_branch_name)
-  syncer.logger.info("Done")
+  return syncer
+
+
+def _import_fetched(syncer, individual_repos_by_branch, checkout):
+  """Imports the fetched individual repos into their destination branches:
+  everything after the fetch, which is local to the monorepo."""
+  metrics = syncer.metrics
+  dest_branch_names = list(individual_repos_by_branch.keys())
+  merged = {}
+  dest_syncers = collections.OrderedDict()
+  for dest_branch_name in dest_branch_names:
+    individual_repos = individual_repos_by_branch[dest_branch_name]
+    dest_syncer = syncer.for_dest_branch(individual_repos)
+    dest_syncers[dest_branch_name] = dest_syncer
+    fetched_repos = [
+        individual_repo for individual_repo in individual_repos
+        if individual_repo.name not in syncer.errors
+    ]
+    with metrics.phase("move"):
+      updated = dest_syncer.create_or_update_individual_repo_branches(
+          dest_branch_name, fetched_repos)
+    with metrics.phase("merge"):
+      merged[dest_branch_name] = dest_syncer.merge_individual_repo_branches(
+          dest_branch_name, updated)
+  with metrics.phase("cleanup"):
+    # Only one destination branch can be checked out.
+    syncer.update_working_directory(merged[dest_branch_names[0]],
+                                    dest_branch_names[0], checkout)
+  with metrics.phase("manifest"):
+    for (dest_branch_name, dest_syncer) in dest_syncers.items():
+      dest_syncer.write_manifest(dest_branch_name)
+
+
+def _upstream_branches(individual_repos_by_branch):
+  """Gets the individual repos to fetch for all the destination branches,
+  once for each upstream branch."""
+  locations = {}
+  upstream_branches = collections.OrderedDict()
+  for individual_repos in individual_repos_by_branch.values():
+    for individual_repo in individual_repos:
+      location = locations.setdefault(individual_repo.name,
+                                      individual_repo.location)
+      if location != individual_repo.location:
+        raise ValueError(
+            "individual repo '{}' has two locations: {} and {}".format(
+                individual_repo.name, location, individual_repo.location))
+      upstream_branches.setdefault(
+          (individual_repo.name, individual_repo.branch), individual_repo)
+  return list(upstream_branches.values())
+
+
+class SyncError(Exception):
+  """Error raised when some individual repos could not be imported.
+
+  Attrs:
+    errors: Dictionary of individual repo names to the exception that
+      prevented their import.
+    metrics: The metrics of the import, of type `metrics.Metrics`, or
+      `None`.
+  """
+
+  def __init__(self, errors, metrics = None):
+    super(SyncError, self).__init__("could not import {}:\n{}".format(
+        ", ".join(sorted(errors)), "\n".join([
+            "{}: {}".format(name, error)
+            for (name, error) in sorted(errors.items())
+        ])))
+    self.errors = errors
+    self.metrics = metrics
+
+
+class InitialCommitError(Exception):
+  """Error raised when the initial commit of a destination branch that was
+  imported into before cannot be found."""
 
 
 class IndividualRepo:
@@ -60,25 +315,57 @@ class IndividualRepo:
       the individual repo.  The destination folder can have multiple parts,
       e.g., `foo/bar`, in which case the subfolders are recursively created.
       The destination folder is by default the `name`.
+    fetch_depth: Optional number of commits to fetch from the tip of
+      `branch` (`git fetch --depth`).  The monorepo becomes shallow.
+    fetch_filter: Optional filter of the objects to fetch, for a partial
+      clone (`git fetch --filter`), e.g. `blob:none` or `blob:limit=1m`.
+      The missing objects are fetched on demand, e.g. when the files are
+      checked out.  Note that the remote must allow filters, and that the
+      mirrors of the mirror cache, if any, are complete.
+    shallow_since: Optional date from which to fetch the history of
+      `branch` (`git fetch --shallow-since`), e.g. `2019-01-01`.  The
+      monorepo becomes shallow.
   """
 
-  def __init__(self, location, branch, name = None, destination = None):
+  def __init__(self,
+               location,
+               branch,
+               name = None,
+               destination = None,
+               fetch_depth = None,
+               fetch_filter = None,
+               shallow_since = None):
     self.location = location
     self.branch = branch
     self.name = name or _default_repo_name(location)
     self.destination = destination or self.name
+    self.fetch_depth = fetch_depth
+    self.fetch_filter = fetch_filter
+    self.shallow_since = shallow_since
 
 
 class _MonorepoSyncer:
 
-  def __init__(self, monorepo, individual_repos, author, committer,
-               logger_name):
+  def __init__(self,
+               monorepo,
+               individual_repos,
+               author,
+               committer,
+               logger_name,
+               engine = ENGINE_WORKTREE,
+               mirror_cache = None):
     self.logger = logging.getLogger(logger_name)
     self.monorepo = monorepo
     self.individual_repos = individual_repos
     self.author = author
     self.committer = committer
-    self.__initial_commit = None
+    self.engine = engine
+    self.mirror_cache = mirror_cache
+    self.errors = {}
+    self.metrics = Metrics()
+    self.__initial_commits = {}
+    self.__manifests = {}
+    self.__moves = {}
 
     self._init_environ()
     self._init_logger()
@@ -101,25 +388,105 @@ class _MonorepoSyncer:
     ch.setFormatter(logging.Formatter("+%(relativeCreated)dms - %(message)s"))
     self.logger.addHandler(ch)
 
+  def for_dest_branch(self, individual_repos):
+    """Gets a syncer for the individual repos of one destination branch.  It
+    shares the metrics, the errors and the caches of this syncer."""
+    syncer = copy.copy(self)
+    syncer.individual_repos = individual_repos
+    return syncer
+
   def _initial_commit(self, dest_branch_name):
-    if not self.__initial_commit:
-      head = self._maybe_head(dest_branch_name)
-      if head:
-        for commit in self.monorepo.iter_commits(dest_branch_name):
-          if commit.message == INITIAL_COMMIT_MESSAGE:
-            self.__initial_commit = commit
-            # Not breaking here but instead going through the full
-            # list of commits ensure that we are selecting the first
-            # commit.  Indeed, `iter_commits` gives back the commits
-            # in reverse chronological order.
-        if not self.__initial_commit:
-          raise Error("cannot find initial commit message")
+    """Gets the initial commit of the destination branch, or creates it.
+    The initial commit is recorded in a dedicated ref, so that it is found
+    in constant time."""
+    if dest_branch_name in self.__initial_commits:
+      return self.__initial_commits[dest_branch_name]
+    ref = Reference(self.monorepo, _initial_commit_ref_name(dest_branch_name))
+    if ref.is_valid():
+      initial_commit = ref.commit
+    else:
+      if self._maybe_head(dest_branch_name):
+        # The destination branch was created before the initial commit was
+        # recorded.
+        initial_commit = self._find_initial_commit(dest_branch_name)
       else:
-        self.__initial_commit = self.monorepo.index.commit(
-            INITIAL_COMMIT_MESSAGE,
-            author = self.author,
-            committer = self.committer)
-    return self.__initial_commit
+        # The destination branches created by the same import share their
+        # initial commit, and then the commits of their individual repo
+        # branches.
+        initial_commit = self.__initial_commits.get(None)
+        if not initial_commit:
+          initial_commit = self._create_initial_commit()
+          self.__initial_commits[None] = initial_commit
+      Reference.create(self.monorepo,
+                       _initial_commit_ref_name(dest_branch_name),
+                       initial_commit)
+    self.__initial_commits[dest_branch_name] = initial_commit
+    return initial_commit
+
+  def _create_initial_commit(self):
+    if self.engine == ENGINE_OBJECTS:
+      return self._commit_tree(
+          write_tree(self.monorepo, []), INITIAL_COMMIT_MESSAGE, [])
+    return self.monorepo.index.commit(
+        INITIAL_COMMIT_MESSAGE,
+        author = self.author,
+        committer = self.committer)
+
+  def _find_initial_commit(self, dest_branch_name):
+    """Finds the initial commit in the history of the destination branch.
+
+    Raises:
+      InitialCommitError: There is no initial commit in the history.
+    """
+    # The initial commit is usually a root commit, and root commits are
+    # listed by Git without parsing every commit in Python.  The initial
+    # commits created on top of the existing history of a monorepo are
+    # found by their message instead.
+    for args in [["--max-parents=0"],
+                 ["--fixed-strings", "--grep=" + INITIAL_COMMIT_MESSAGE]]:
+      initial_commit = None
+      # Not stopping at the first match selects the oldest initial commit,
+      # as the commits are given in reverse chronological order.
+      hexshas = self.monorepo.git.rev_list(*(args + [dest_branch_name]))
+      for hexsha in hexshas.split():
+        commit = self.monorepo.commit(hexsha)
+        if commit.message == INITIAL_COMMIT_MESSAGE:
+          initial_commit = commit
+      if initial_commit:
+        return initial_commit
+    raise InitialCommitError(
+        "cannot find the initial commit of '{}'".format(dest_branch_name))
+
+  def _manifest(self, dest_branch_name):
+    """Gets the manifest of the previous import, or `None`."""
+    if dest_branch_name not in self.__manifests:
+      self.__manifests[dest_branch_name] = read_manifest(
+          self.monorepo, dest_branch_name)
+    return self.__manifests[dest_branch_name]
+
+  def _is_up_to_date(self, individual_repo, dest_branch_name,
+                     upstream_commit, repo_branch):
+    """Tells whether the upstream commit was already merged into the
+    individual repo branch.  The manifest answers in constant time; the
+    commit graph is walked otherwise."""
+    manifest = self._manifest(dest_branch_name) or {"individual_repos": {}}
+    entry = manifest["individual_repos"].get(individual_repo.name)
+    if (entry and entry["upstream_commit"] == upstream_commit.hexsha and
+        entry["individual_repo_commit"] == repo_branch.commit.hexsha):
+      return True
+    return self.monorepo.is_ancestor(upstream_commit, repo_branch.commit)
+
+  def _commit_tree(self, tree_binsha, message, parent_commits):
+    """Creates a commit from a tree, without touching the index, the
+    working tree or `HEAD`."""
+    return Commit.create_from_tree(
+        self.monorepo,
+        Tree(self.monorepo, tree_binsha),
+        message,
+        parent_commits = list(parent_commits),
+        head = False,
+        author = self.author,
+        committer = self.committer)
 
   def _remote_exists(self, name):
     try:
@@ -134,106 +501,534 @@ class _MonorepoSyncer:
     except IndexError:
       return None
 
-  def create_remotes(self):
-    self.logger.info("Create the individual repo remotes...")
-    for individual_repo in self.individual_repos:
-      self.logger.info("For {}".format(individual_repo.name))
-      if self._remote_exists(individual_repo.name):
-        self.monorepo.delete_remote(individual_repo.name)
-      remote = self.monorepo.create_remote(individual_repo.name,
-                                           individual_repo.location)
-
-  def create_or_update_individual_repo_branches(self,
-                                                dest_branch_name,
-                                                fetch_depth = None):
-    self.logger.info("Create or update individual repo branches...")
-    to_update = []
+  def create_remotes(self, dest_branch_names, prune = False):
+    """Creates the remotes of the individual repos, or updates them in
+    place.  Remotes are never recreated, so that their remote-tracking refs
+    are kept for the next fetches.
+
+    Returns:
+      The names of the stale remotes, i.e., the remotes of the individual
+      repos previously imported into one of `dest_branch_names` that are
+      not imported anymore.  They are deleted if `prune` is `True`.
+    """
+    self.logger.info("Create or update the individual repo remotes...")
     for individual_repo in self.individual_repos:
       repo_name = individual_repo.name
-      branch_name = _individual_repo_branch_name(dest_branch_name, repo_name)
-      self.logger.info("{}: pulling...".format(repo_name))
-      repo_branch = self._maybe_head(branch_name)
-      repo_branch_created = False
-      if not repo_branch:
-        repo_branch_created = True
-        repo_branch = self.monorepo.create_head(
-            branch_name, self._initial_commit(dest_branch_name))
-      repo_branch.checkout()
-      commit_before_pull = repo_branch.commit
-      self.monorepo.remotes[repo_name].pull(
-          individual_repo.branch,
-          allow_unrelated_histories = repo_branch_created,
-          depth = fetch_depth)
-      commit_after_pull = repo_branch.commit
-      if commit_before_pull == commit_after_pull:
-        self.logger.info("{}: SKIP: up-to-date".format(repo_name))
+      url = self._remote_url(individual_repo)
+      if not self._remote_exists(repo_name):
+        self.logger.info("{}: create remote".format(repo_name))
+        self.monorepo.create_remote(repo_name, url)
+        continue
+      remote = self.monorepo.remote(repo_name)
+      if remote.url != url:
+        self.logger.info("{}: update remote URL".format(repo_name))
+        with remote.config_writer as writer:
+          writer.set("url", url)
+    stale_remotes = self._stale_remotes(dest_branch_names)
+    for repo_name in stale_remotes:
+      if prune:
+        self.logger.info("{}: delete stale remote".format(repo_name))
+        self.monorepo.delete_remote(repo_name)
+      else:
+        self.logger.warning("{}: stale remote".format(repo_name))
+    return stale_remotes
+
+  def _remote_url(self, individual_repo):
+    if self.mirror_cache:
+      return self.mirror_cache.mirror_path(individual_repo.location)
+    return individual_repo.location
+
+  def _stale_remotes(self, dest_branch_names):
+    """Lists the remotes of the individual repos that were imported into
+    one of `dest_branch_names` and are not imported anymore.  The remotes
+    are shared by all the destination branches: a remote that the
+    individual repo branch of another destination branch still uses is
+    not stale."""
+    prefixes = [
+        _individual_repo_branch_name(dest_branch_name, "")
+        for dest_branch_name in dest_branch_names
+    ]
+    imported = set()
+    other_heads = []
+    for head in self.monorepo.heads:
+      matching = [prefix for prefix in prefixes if head.name.startswith(prefix)]
+      if matching:
+        imported.add(head.name[len(matching[0]):])
+      elif head.name.startswith(_INDIVIDUAL_REPO_BRANCH_PREFIX):
+        other_heads.append(head.name)
+    current = set(
+        [individual_repo.name for individual_repo in self.individual_repos])
+    return sorted([
+        remote.name
+        for remote in self.monorepo.remotes
+        if remote.name in imported and remote.name not in current and
+        not any(name.endswith("/" + remote.name) for name in other_heads)
+    ])
+
+  def fetch_individual_repos(self,
+                             jobs = 1,
+                             fetch_depth = None,
+                             fetch_filter = None,
+                             shallow_since = None):
+    """Fetches the individual repos into their remote-tracking refs, with
+    at most `jobs` concurrent fetches.  The individual repos whose upstream
+    branch did not move since the last fetch are not fetched again.
+
+    `fetch_depth`, `fetch_filter` and `shallow_since` are the defaults for
+    the individual repos that do not set them.
+
+    Returns:
+      The individual repos that were successfully fetched or that were
+      already up-to-date.  The errors are recorded in `self.errors`.
+    """
+    unchanged = self._unchanged_upstreams(jobs)
+    to_fetch = [
+        individual_repo for individual_repo in self.individual_repos
+        if individual_repo.name not in unchanged
+    ]
+    if self.mirror_cache:
+      self._update_mirrors(to_fetch, jobs)
+    self.logger.info("Fetch individual repos...")
+
+    def fetch(individual_repo):
+      self.logger.info("{}: fetching...".format(individual_repo.name))
+      with self.metrics.phase("fetch", individual_repo.name):
+        (_, _, progress) = self.monorepo.git.fetch(
+            *self._fetch_args(individual_repo, fetch_depth, fetch_filter,
+                              shallow_since),
+            with_extended_output = True)
+        self.metrics.count_fetch(progress)
+
+    (to_fetch, shallow) = self._prepare_fetches(to_fetch, fetch_depth,
+                                                fetch_filter, shallow_since)
+    results = (map_in_pool(fetch, to_fetch, jobs) +
+               map_in_pool(fetch, shallow, 1))
+    for (individual_repo, (_, error)) in zip(to_fetch + shallow, results):
+      if error:
+        self._record_error(individual_repo, error)
+    return self._fetched_individual_repos()
+
+  def _prepare_fetches(self, to_fetch, fetch_depth, fetch_filter,
+                       shallow_since):
+    """Configures the remotes of the individual repos to fetch.  The
+    configuration is written before the concurrent fetches, which would
+    otherwise compete for the lock of the configuration file.
+
+    Returns:
+      A `(to_fetch, shallow)` pair of lists of individual repos to fetch,
+      without the failed ones.  The shallow fetches, in `shallow`, all
+      update `.git/shallow` under a lock: they must run one at a time.
+      The fetches in `to_fetch` can run concurrently.
+    """
+    to_fetch = [
+        individual_repo for individual_repo in to_fetch
+        if individual_repo.name not in self.errors
+    ]
+    # The individual repos that are not fetched, because their upstream did
+    # not move, are configured too: their filter may have been removed.
+    for individual_repo in self.individual_repos:
+      if individual_repo.name in self.errors:
+        continue
+      self._configure_promisor(individual_repo.name,
+                               individual_repo.fetch_filter or fetch_filter)
+    shallow = [
+        individual_repo for individual_repo in to_fetch
+        if _is_shallow_fetch(individual_repo, fetch_depth, shallow_since)
+    ]
+    return ([
+        individual_repo for individual_repo in to_fetch
+        if individual_repo not in shallow
+    ], shallow)
+
+  def _fetch_args(self, individual_repo, fetch_depth, fetch_filter,
+                  shallow_since):
+    """Gets the arguments of the `git fetch` of an individual repo into its
+    remote-tracking ref."""
+    args = ["--progress"]
+    depth = individual_repo.fetch_depth or fetch_depth
+    if depth:
+      args.append("--depth={}".format(depth))
+    fetch_filter = individual_repo.fetch_filter or fetch_filter
+    if fetch_filter:
+      args.append("--filter={}".format(fetch_filter))
+    shallow_since = individual_repo.shallow_since or shallow_since
+    if shallow_since:
+      args.append("--shallow-since={}".format(shallow_since))
+    return args + [
+        individual_repo.name,
+        "+{}:{}".format(individual_repo.branch,
+                        _remote_tracking_ref_name(individual_repo))
+    ]
+
+  def _fetched_individual_repos(self):
+    return [
+        individual_repo for individual_repo in self.individual_repos
+        if individual_repo.name not in self.errors
+    ]
+
+  def _configure_promisor(self, repo_name, fetch_filter):
+    """Configures the remote of an individual repo as a promisor remote,
+    which the objects left out by `fetch_filter` are fetched from on
+    demand.  Recent versions of Git do it on their own.  Without
+    `fetch_filter`, the remote is not a promisor remote anymore, and its
+    next fetches are complete."""
+    remote = self.monorepo.remote(repo_name)
+    expected = {}
+    if fetch_filter:
+      expected = {"promisor": "true", "partialclonefilter": fetch_filter}
+    reader = remote.config_reader
+    current = dict([(option, reader.get(option))
+                    for option in ["promisor", "partialclonefilter"]
+                    if reader.has_option(option)])
+    if current == expected:
+      # The configuration file is not locked and rewritten for nothing.
+      return
+    with remote.config_writer as writer:
+      for option in current:
+        if option not in expected:
+          writer.remove_option(option)
+      for (option, value) in expected.items():
+        writer.set(option, value)
+
+  def _unchanged_upstreams(self, jobs):
+    """Lists the individual repos whose upstream branch still points to
+    the object recorded in their remote-tracking ref.  There is one
+    `ls-remote` per location, and no object is transferred.
+
+    Returns:
+      A set of individual repo names.
+    """
+    recorded = self._recorded_upstreams()
+    if not recorded:
+      return set()
+    self.logger.info("Check upstream branches...")
+    locations = sorted(recorded.keys())
+
+    def ls_remote(location):
+      return _parse_ls_remote(
+          self.monorepo.git.ls_remote(location,
+                                      *_ls_remote_args(recorded[location])))
+
+    results = map_in_pool(ls_remote, locations, jobs)
+    return self._unchanged_upstreams_in(recorded, [
+        (location, remote_refs)
+        for (location, (remote_refs, error)) in zip(locations, results)
+        if not error
+    ])
+
+  def _recorded_upstreams(self):
+    """Gets the objects recorded in the remote-tracking refs of the
+    individual repos that were already fetched.
+
+    Returns:
+      A dictionary of individual repo locations to lists of
+      `(individual_repo, hexsha)` pairs.
+    """
+    recorded = {}
+    for individual_repo in self.individual_repos:
+      tracking_ref = _remote_tracking_ref_name(individual_repo)
+      try:
+        hexsha = SymbolicReference.dereference_recursive(
+            self.monorepo, tracking_ref)
+      except ValueError:
+        # Never fetched
         continue
-      to_update.append(repo_name)
-      self.logger.info(
-          "{}: create destination directories...".format(repo_name))
-      repo_branch.checkout()
-      index = self.monorepo.index
-      filenames = []
-      for (key, value) in index.entries.items():
-        filename = key[0]
-        append = True
-        for cur in self.individual_repos:
-          if filename.startswith(cur.destination + "/"):
-            append = False
-            break
-        if append:
-          filenames.append(filename)
-      dest_dirs_to_add = []
-      for filename in filenames:
-        dest_dir_rel = os.path.dirname(
-            os.path.join(individual_repo.destination, filename))
-        dest_dir_abs = os.path.join(self.monorepo.working_dir, dest_dir_rel)
-        dest_dirs_to_add.append(dest_dir_abs)
-        if not os.path.exists(dest_dir_abs):
-          os.makedirs(dest_dir_abs)
-      #index.add(dest_dirs_to_add)
-      self.logger.info("{}: move files...".format(repo_name))
-      for dest_dir_abs in set(dest_dirs_to_add):
-        dest_dir_rel = os.path.relpath(dest_dir_abs, self.monorepo.working_dir)
-        src_dir_rel = os.path.relpath(dest_dir_rel, individual_repo.destination)
-        if src_dir_rel == ".":
-          src_dir_rel = ""
+      recorded.setdefault(individual_repo.location, []).append(
+          (individual_repo, hexsha))
+    return recorded
+
+  def _unchanged_upstreams_in(self, recorded, remote_refs_by_location):
+    """Compares the objects recorded by `_recorded_upstreams` with the
+    remote refs, as listed by `ls-remote`, of some locations.  The
+    locations that could not be listed are left out: the fetch will tell
+    what is wrong.
+
+    Returns:
+      A set of individual repo names.
+    """
+    unchanged = set()
+    for (location, remote_refs) in remote_refs_by_location:
+      for (individual_repo, hexsha) in recorded[location]:
+        if _resolve_remote_ref(remote_refs, individual_repo.branch) == hexsha:
+          self.logger.info("{}: upstream unchanged".format(
+              individual_repo.name))
+          unchanged.add(individual_repo.name)
+    return unchanged
+
+  def _update_mirrors(self, individual_repos, jobs):
+    self.logger.info("Update mirrors...")
+    locations = _locations(individual_repos)
+
+    def update(location):
+      self.logger.info("{}: updating mirror...".format(location))
+      self.mirror_cache.update(location)
+
+    results = map_in_pool(update, locations, jobs)
+    for (location, (_, error)) in zip(locations, results):
+      if error:
+        self._record_location_error(individual_repos, location, error)
+    self._evict_mirrors()
+
+  def _evict_mirrors(self):
+    for path in self.mirror_cache.evict(keep = [
+        self.mirror_cache.mirror_path(individual_repo.location)
+        for individual_repo in self.individual_repos
+    ]):
+      self.logger.info("Evicted mirror {}".format(path))
+
+  def _record_location_error(self, individual_repos, location, error):
+    for individual_repo in individual_repos:
+      if individual_repo.location == location:
+        self._record_error(individual_repo, error)
+
+  def _record_error(self, individual_repo, error):
+    self.logger.error("{}: FAILED: {}".format(individual_repo.name, error))
+    self.errors[individual_repo.name] = error
+
+  def create_or_update_individual_repo_branches(self, dest_branch_name,
+                                                fetched_repos):
+    self.logger.info("Create or update individual repo branches...")
+    to_update = []
+    for individual_repo in fetched_repos:
+      with self.metrics.phase("move", individual_repo.name):
+        if self.engine == ENGINE_OBJECTS:
+          updated = self._update_branch_from_objects(individual_repo,
+                                                     dest_branch_name)
         else:
-          src_dir_rel += os.path.sep
-        cur_filenames = []
-        for filename in filenames:
-          if filename.startswith(src_dir_rel.replace(os.path.sep, "/")):
-            if "/" not in filename[len(src_dir_rel):]:
-              cur_filenames.append(filename)
-        cur_filenames.append(dest_dir_rel)
-        index.move(cur_filenames)
-      repo_branch.reference = index.commit(
-          "Move files from repo {} to directory {}".format(
-              repo_name, individual_repo.destination),
-          author = self.author,
-          committer = self.committer)
+          updated = self._update_branch_in_worktree(individual_repo,
+                                                    dest_branch_name)
+      if updated:
+        to_update.append(individual_repo.name)
     return to_update
 
-  def merge_individual_repo_branches(self, to_update, dest_branch_name):
+  def _upstream_commit(self, individual_repo):
+    return self.monorepo.commit(_remote_tracking_ref_name(individual_repo))
+
+  def _update_branch_from_objects(self, individual_repo, dest_branch_name):
+    repo_name = individual_repo.name
+    branch_name = _individual_repo_branch_name(dest_branch_name, repo_name)
+    upstream_commit = self._upstream_commit(individual_repo)
+    repo_branch = self._maybe_head(branch_name)
+    if not repo_branch:
+      repo_branch = self.monorepo.create_head(
+          branch_name, self._initial_commit(dest_branch_name))
+    elif self._is_up_to_date(individual_repo, dest_branch_name,
+                             upstream_commit, repo_branch):
+      self.logger.info("{}: SKIP: up-to-date".format(repo_name))
+      return False
+    move_key = self._move_key(individual_repo, repo_branch, upstream_commit)
+    if move_key in self.__moves:
+      self.logger.info("{}: reuse move".format(repo_name))
+      repo_branch.commit = self.__moves[move_key]
+      return True
+    self.logger.info("{}: move files...".format(repo_name))
+    # Same commit graph as with `ENGINE_WORKTREE`: the upstream history is
+    # merged, then the files are moved.  The merge takes the upstream tree
+    # as is, and the move nests it under the destination.
+    pull_commit = self._commit_tree(upstream_commit.tree.binsha,
+                                    _pull_commit_message(individual_repo),
+                                    [repo_branch.commit, upstream_commit])
+    repo_branch.commit = self._commit_tree(
+        nest_tree(self.monorepo, upstream_commit.tree.binsha,
+                  individual_repo.destination),
+        _move_commit_message(individual_repo), [pull_commit])
+    self.__moves[move_key] = repo_branch.commit
+    return True
+
+  def _update_branch_in_worktree(self, individual_repo, dest_branch_name):
+    repo_name = individual_repo.name
+    branch_name = _individual_repo_branch_name(dest_branch_name, repo_name)
+    upstream_commit = self._upstream_commit(individual_repo)
+    repo_branch = self._maybe_head(branch_name)
+    repo_branch_created = False
+    resumed = False
+    if repo_branch and _is_move_pending(individual_repo, repo_branch):
+      # A previous import was interrupted after the upstream history was
+      # merged, but before the files were moved.
+      self.logger.info("{}: resume move...".format(repo_name))
+      repo_branch.checkout(force = True)
+      # Files that were already moved are not tracked.
+      self.monorepo.git.clean(d = True, f = True)
+      self._move_files_in_worktree(individual_repo, repo_branch)
+      resumed = True
+    if not repo_branch:
+      repo_branch_created = True
+      repo_branch = self.monorepo.create_head(
+          branch_name, self._initial_commit(dest_branch_name))
+    elif self._is_up_to_date(individual_repo, dest_branch_name,
+                             upstream_commit, repo_branch):
+      # Comparing the commits before checking out the branch makes the
+      # common, no-op case free of any write to the working tree.
+      self.logger.info("{}: SKIP: up-to-date".format(repo_name))
+      return resumed
+    move_key = self._move_key(individual_repo, repo_branch, upstream_commit)
+    if move_key in self.__moves:
+      self.logger.info("{}: reuse move".format(repo_name))
+      repo_branch.commit = self.__moves[move_key]
+      return True
+    self.logger.info("{}: merging...".format(repo_name))
+    # The working tree may be left over from an interrupted import.
+    repo_branch.checkout(force = True)
+    if (repo_branch_created or
+        self.monorepo.merge_base(repo_branch.commit, upstream_commit)):
+      # The individual repo was already fetched: merging the remote-tracking
+      # ref is the same as pulling, without another network round-trip.
+      self.monorepo.git.merge(
+          upstream_commit.hexsha,
+          m = _pull_commit_message(individual_repo),
+          allow_unrelated_histories = repo_branch_created)
+    else:
+      self._merge_cut_off_history(individual_repo, upstream_commit)
+    self._move_files_in_worktree(individual_repo, repo_branch)
+    self.__moves[move_key] = repo_branch.commit
+    return True
+
+  def _merge_cut_off_history(self, individual_repo, upstream_commit):
+    """Merges an upstream commit whose history was cut off by a shallow
+    fetch into the checked out individual repo branch.  Without a merge
+    base, the files of the upstream commit replace the files of the branch,
+    as with `ENGINE_OBJECTS`."""
+    self.monorepo.git.merge(
+        upstream_commit.hexsha,
+        strategy = "ours",
+        no_commit = True,
+        allow_unrelated_histories = True)
+    self.monorepo.git.read_tree(upstream_commit.hexsha, reset = True, u = True)
+    self.monorepo.git.commit(
+        m = _pull_commit_message(individual_repo), no_verify = True)
+
+  def _move_key(self, individual_repo, repo_branch, upstream_commit):
+    """Identifies the move of an individual repo branch to an upstream
+    commit, so that it is reused when the individual repo branch of another
+    destination branch is at the same commit."""
+    # The moves of `ENGINE_WORKTREE` also depend on the destinations of the
+    # other individual repos.
+    return (repo_branch.commit.hexsha, upstream_commit.hexsha,
+            individual_repo.location, individual_repo.branch,
+            individual_repo.destination,
+            tuple(sorted(cur.destination for cur in self.individual_repos)))
+
+  def _move_files_in_worktree(self, individual_repo, repo_branch):
+    self.logger.info("{}: move files...".format(individual_repo.name))
+    index = self.monorepo.index
+    # Files that are in the destination folder of an individual repo were
+    # already moved.
+    destinations = set([
+        cur.destination.strip("/") for cur in self.individual_repos
+    ])
+    destination = individual_repo.destination.strip("/")
+    # The index entries are renamed in memory and the index is written once,
+    # instead of spawning one `git mv` per directory.
+    entries = index.entries
+    files_moved = 0
+    for (filename, stage) in list(entries.keys()):
+      if _is_in_any_directory(filename, destinations):
+        continue
+      files_moved += 1
+      entry = entries.pop((filename, stage))
+      dest_filename = posixpath.join(destination, filename)
+      entries[(dest_filename, stage)] = IndexEntry(entry[:3] +
+                                                   (dest_filename,) +
+                                                   entry[4:])
+      os.renames(
+          os.path.join(self.monorepo.working_dir, filename),
+          os.path.join(self.monorepo.working_dir, dest_filename))
+    self.metrics.increment(FILES_MOVED, files_moved)
+    # The cached trees of the index are out of date.
+    index.write(ignore_extension_data = True)
+    repo_branch.reference = index.commit(
+        _move_commit_message(individual_repo),
+        author = self.author,
+        committer = self.committer)
+
+  def merge_individual_repo_branches(self, dest_branch_name, updated = ()):
+    """Merges the individual repo branches that are not merged yet into the
+    destination branch.
+
+    Whether an individual repo branch is merged is read from the commit
+    graph, not only from the branches `updated` by this import, so that the
+    merges of an interrupted import are done by the next one.  The merge commits
+    are created first, and the destination branch is updated once at the
+    end: an interrupted merge leaves it untouched.
+
+    Returns:
+      The names of the individual repos that were merged.
+    """
     self.logger.info("Merge old repo branches...")
     dest_branch = self._maybe_head(dest_branch_name)
     if not dest_branch:
       dest_branch = self.monorepo.create_head(
           dest_branch_name, self._initial_commit(dest_branch_name))
-    dest_branch.checkout()
-    for repo_name in to_update:
+    to_merge = self._unmerged_individual_repos(dest_branch, dest_branch_name,
+                                               updated)
+    if not to_merge:
+      return to_merge
+    if self.engine == ENGINE_OBJECTS:
+      dest_commit = self._merge_from_objects(to_merge, dest_branch,
+                                             dest_branch_name)
+    else:
+      dest_commit = self._merge_in_worktree(to_merge, dest_branch,
+                                            dest_branch_name)
+    dest_branch.commit = dest_commit
+    return to_merge
+
+  def _unmerged_individual_repos(self, dest_branch, dest_branch_name,
+                                 updated):
+    manifest = self._manifest(dest_branch_name) or {"individual_repos": {}}
+    is_manifest_current = (
+        manifest.get("dest_commit") == dest_branch.commit.hexsha)
+    to_merge = []
+    for individual_repo in self.individual_repos:
+      repo_name = individual_repo.name
+      if repo_name in updated:
+        # The individual repo branch was just moved to a new commit.
+        to_merge.append(repo_name)
+        continue
+      repo_branch = self._maybe_head(
+          _individual_repo_branch_name(dest_branch_name, repo_name))
+      if not repo_branch:
+        continue
+      entry = manifest["individual_repos"].get(repo_name)
+      if (is_manifest_current and entry and
+          entry["individual_repo_commit"] == repo_branch.commit.hexsha):
+        continue
+      if not self.monorepo.is_ancestor(repo_branch.commit,
+                                       dest_branch.commit):
+        to_merge.append(repo_name)
+    return to_merge
+
+  def _merge_in_worktree(self, to_merge, dest_branch, dest_branch_name):
+    # The index may be left over from an interrupted import.
+    dest_branch.checkout(force = True)
+    dest_commit = dest_branch.commit
+    for repo_name in to_merge:
       self.logger.info("{}: merge".format(repo_name))
-      source_branch = self.monorepo.heads[_individual_repo_branch_name(
-          dest_branch_name, repo_name)]
-      merge_base = self.monorepo.merge_base(dest_branch, source_branch)
-      index = self.monorepo.index
-      index.merge_tree(source_branch, base = merge_base)
-      next_commit = index.commit(
-          "Merge repo {}".format(repo_name),
-          parent_commits = (source_branch.commit, dest_branch.commit),
-          author = self.author,
-          committer = self.committer)
-      dest_branch.commit = next_commit
+      with self.metrics.phase("merge", repo_name):
+        source_branch = self.monorepo.heads[_individual_repo_branch_name(
+            dest_branch_name, repo_name)]
+        merge_base = self.monorepo.merge_base(dest_commit, source_branch)
+        index = self.monorepo.index
+        index.merge_tree(source_branch, base = merge_base)
+        dest_commit = index.commit(
+            "Merge repo {}".format(repo_name),
+            parent_commits = (source_branch.commit, dest_commit),
+            head = False,
+            author = self.author,
+            committer = self.committer)
+        self.metrics.increment(MERGES)
+    return dest_commit
+
+  def update_working_directory(self,
+                               to_update,
+                               dest_branch_name,
+                               checkout = True):
+    dest_branch = self.monorepo.heads[dest_branch_name]
+    if self.engine == ENGINE_OBJECTS:
+      if checkout:
+        self._checkout_lazily(dest_branch, to_update)
+      return
+    if not to_update and self._is_checked_out(dest_branch):
+      return
     self.logger.info("Clean up working directory...")
     self.monorepo.head.reference = dest_branch
     for entry in os.listdir(self.monorepo.working_dir):
@@ -246,6 +1041,84 @@ class _MonorepoSyncer:
         shutil.rmtree(path)
     self.monorepo.head.reset(index = True, working_tree = True)
 
+  def write_manifest(self, dest_branch_name):
+    """Records the individual repos imported into the destination branch.
+    The individual repos that could not be imported keep their previous
+    record, if any."""
+    previous = self._manifest(dest_branch_name)
+    previous_entries = previous["individual_repos"] if previous else {}
+    entries = {}
+    for individual_repo in self.individual_repos:
+      repo_name = individual_repo.name
+      repo_branch = self._maybe_head(
+          _individual_repo_branch_name(dest_branch_name, repo_name))
+      if repo_name in self.errors or not repo_branch:
+        if repo_name in previous_entries:
+          entries[repo_name] = previous_entries[repo_name]
+        continue
+      entries[repo_name] = collections.OrderedDict([
+          ("location", individual_repo.location),
+          ("branch", individual_repo.branch),
+          ("destination", individual_repo.destination),
+          ("upstream_commit", self._upstream_commit(individual_repo).hexsha),
+          ("individual_repo_commit", repo_branch.commit.hexsha),
+      ])
+    manifest = collections.OrderedDict([
+        ("version", MANIFEST_VERSION),
+        ("dest_branch", dest_branch_name),
+        ("dest_commit", self.monorepo.heads[dest_branch_name].commit.hexsha),
+        ("individual_repos", entries),
+    ])
+    write_manifest(self.monorepo, dest_branch_name, manifest, self.author,
+                   self.committer)
+    self.__manifests[dest_branch_name] = manifest
+
+  def _merge_from_objects(self, to_merge, dest_branch, dest_branch_name):
+    individual_repos = {
+        individual_repo.name: individual_repo
+        for individual_repo in self.individual_repos
+    }
+    dest_commit = dest_branch.commit
+    for repo_name in to_merge:
+      self.logger.info("{}: merge".format(repo_name))
+      with self.metrics.phase("merge", repo_name):
+        source_branch = self.monorepo.heads[_individual_repo_branch_name(
+            dest_branch_name, repo_name)]
+        tree = self._splice_individual_repo(dest_commit.tree.binsha,
+                                            source_branch.commit.tree.binsha,
+                                            individual_repos[repo_name])
+        dest_commit = self._commit_tree(tree,
+                                        "Merge repo {}".format(repo_name),
+                                        [source_branch.commit, dest_commit])
+        self.metrics.increment(MERGES)
+    return dest_commit
+
+  def _splice_individual_repo(self, dest_tree, source_tree, individual_repo):
+    """Merges an individual repo by replacing its destination folder in
+    the tree of the destination branch."""
+    destination = individual_repo.destination
+    tree = splice_tree(self.monorepo, dest_tree, destination,
+                       subtree_at(self.monorepo, source_tree, destination))
+    # The individual repos that are nested in this one are left untouched.
+    for other in self.individual_repos:
+      if _is_nested(other.destination, destination):
+        tree = splice_tree(
+            self.monorepo, tree, other.destination,
+            subtree_at(self.monorepo, dest_tree, other.destination))
+    return tree
+
+  def _is_checked_out(self, branch):
+    head = self.monorepo.head
+    return not head.is_detached and head.reference.path == branch.path
+
+  def _checkout_lazily(self, dest_branch, to_update):
+    if not to_update and self._is_checked_out(dest_branch):
+      return
+    self.logger.info("Update working directory...")
+    # Only the files that changed are rewritten.
+    self.monorepo.head.reference = dest_branch
+    self.monorepo.head.reset(index = True, working_tree = True)
+
 
 def _default_repo_name(repo_location):
   name = repo_location[repo_location.rindex(os.sep) + 1:]
@@ -255,4 +1128,87 @@ def _default_repo_name(repo_location):
 
 
 def _individual_repo_branch_name(dest_branch_name, repo_name):
-  return 'individual_repos/{}/{}'.format(dest_branch_name, repo_name)
+  return _INDIVIDUAL_REPO_BRANCH_PREFIX + '{}/{}'.format(
+      dest_branch_name, repo_name)
+
+
+def _is_move_pending(individual_repo, repo_branch):
+  """Tells whether the upstream history was merged into the individual repo
+  branch without the files being moved."""
+  return (repo_branch.commit.message.strip() ==
+          _pull_commit_message(individual_repo).strip())
+
+
+def _initial_commit_ref_name(dest_branch_name):
+  return 'refs/monorepo-tools/{}/initial'.format(dest_branch_name)
+
+
+def _remote_tracking_ref_name(individual_repo):
+  return 'refs/remotes/{}/{}'.format(individual_repo.name,
+                                     individual_repo.branch)
+
+
+def _is_shallow_fetch(individual_repo, fetch_depth, shallow_since):
+  return bool(individual_repo.fetch_depth or fetch_depth or
+              individual_repo.shallow_since or shallow_since)
+
+
+def _locations(individual_repos):
+  """Gets the sorted locations of individual repos.  Each location appears
+  once, even if many individual repos share it."""
+  return sorted(
+      set([individual_repo.location for individual_repo in individual_repos]))
+
+
+def _ls_remote_args(recorded_upstreams):
+  """Gets the branches to list with `ls-remote` for the recorded upstreams
+  of a location (see `_MonorepoSyncer._recorded_upstreams`)."""
+  return sorted(
+      set([individual_repo.branch
+           for (individual_repo, _) in recorded_upstreams]))
+
+
+def _parse_ls_remote(output):
+  remote_refs = {}
+  for line in output.splitlines():
+    if line.strip():
+      (hexsha, ref) = line.split("\t", 1)
+      remote_refs[ref] = hexsha
+  return remote_refs
+
+
+def _resolve_remote_ref(remote_refs, branch):
+  """Resolves a branch, tag or ref name the same way `git fetch` does."""
+  for pattern in [
+      "{}", "refs/{}", "refs/tags/{}", "refs/heads/{}", "refs/remotes/{}",
+      "refs/remotes/{}/HEAD"
+  ]:
+    ref = pattern.format(branch)
+    if ref in remote_refs:
+      return remote_refs[ref]
+  return None
+
+
+def _is_in_any_directory(path, directories):
+  """Tells whether a path is in one of the directories, in a time
+  proportional to the depth of the path."""
+  index = path.find("/")
+  while index != -1:
+    if path[:index] in directories:
+      return True
+    index = path.find("/", index + 1)
+  return False
+
+
+def _is_nested(destination, parent_destination):
+  return destination.strip("/").startswith(parent_destination.strip("/") + "/")
+
+
+def _pull_commit_message(individual_repo):
+  return "Merge branch '{}' of {}".format(individual_repo.branch,
+                                          individual_repo.location)
+
+
+def _move_commit_message(individual_repo):
+  return "Move files from repo {} to directory {}".format(
+      individual_repo.name, individual_repo.destination)
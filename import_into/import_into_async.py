@@ -0,0 +1,313 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Asyncio entry point of the import, for services that drive imports from
+an event loop.
+
+The git network operations of an import, i.e., the `ls-remote` of the
+upstream branches, the updates of the mirror cache and the fetches, run as
+asyncio subprocesses: at most `jobs` at a time, each with its own timeout,
+and killed when the import is cancelled.  The local work on the monorepo
+is blocking: it runs serially on a thread pool, so that the event loop is
+free in the meantime.
+
+Unlike the rest of the package, this module requires Python 3.5 or later.
+"""
+import asyncio
+import collections
+import functools
+import os
+import subprocess
+import time
+from git import GitCommandError
+from monorepo_tools.import_into.git_backend import git_backend
+from monorepo_tools.import_into.import_into import (
+    DEFAULT_AUTHOR, DEFAULT_COMMITTER, DEFAULT_LOGGER_NAME, SyncError,
+    _check_options, _new_syncer, _import_fetched, _locations,
+    _ls_remote_args, _parse_ls_remote)
+from monorepo_tools.import_into.metrics import (count_git_processes,
+                                                GIT_PROCESSES)
+from monorepo_tools.import_into.mirror_cache import MIRROR_FETCH_ARGS
+
+
+async def import_into_monorepo_async(monorepo,
+                                     individual_repos,
+                                     dest_branch_name = "master",
+                                     **kwargs):
+  """Same as `import_into.import_into_monorepo`, as a coroutine.
+
+  Args:
+    individual_repos, dest_branch_name: See
+      `import_into.import_into_monorepo`.
+    For the other arguments, see `import_into_monorepo_branches_async`.
+  Returns:
+    The metrics of the import, of type `metrics.Metrics`.
+  Raises:
+    SyncError: Some individual repos could not be fetched.  The other
+      individual repos are still imported.
+  """
+  return await import_into_monorepo_branches_async(
+      monorepo,
+      collections.OrderedDict([(dest_branch_name, individual_repos)]),
+      **kwargs)
+
+
+async def import_into_monorepo_branches_async(monorepo,
+                                              individual_repos_by_branch,
+                                              silent = False,
+                                              author = DEFAULT_AUTHOR,
+                                              committer = DEFAULT_COMMITTER,
+                                              logger_name = DEFAULT_LOGGER_NAME,
+                                              engine = None,
+                                              checkout = True,
+                                              jobs = 1,
+                                              timeout = None,
+                                              executor = None,
+                                              prune_remotes = False,
+                                              mirror_cache_dir = None,
+                                              mirror_cache_max_size = None,
+                                              fetch_depth = None,
+                                              fetch_filter = None,
+                                              shallow_since = None):
+  """Same as `import_into.import_into_monorepo_branches`, as a coroutine.
+
+  Cancelling the coroutine kills the git network operations in progress.
+  The local work in progress, if any, is completed first, and an import
+  that is cancelled during the merges is resumed by the next import.
+
+  Args:
+    jobs: The maximum number of git network operations running
+      concurrently.
+    timeout: Optional timeout, in seconds, of each git network operation,
+      e.g., the fetch of one individual repo.  The individual repos whose
+      operation timed out are reported in `SyncError`, like the other
+      failures, and the other individual repos are still imported.
+    executor: The `concurrent.futures.Executor` to do the local work with.
+      By default, the default executor of the event loop.
+    For the other arguments, see `import_into.import_into_monorepo`.
+  Returns:
+    The metrics of the import, of type `metrics.Metrics`, for all the
+    destination branches.
+  Raises:
+    SyncError: Some individual repos could not be fetched.  The other
+      individual repos are still imported.
+  """
+  (engine, checkout) = _check_options(monorepo, individual_repos_by_branch,
+                                      engine, checkout)
+  syncer = _new_syncer(monorepo, individual_repos_by_branch, silent, author,
+                       committer, logger_name, engine, mirror_cache_dir,
+                       mirror_cache_max_size)
+  metrics = syncer.metrics
+  local = _LocalRunner(executor)
+  with count_git_processes(monorepo, metrics), git_backend(monorepo):
+    remote = _RemoteRunner(monorepo, metrics, jobs, timeout)
+    with metrics.phase("create_remotes"):
+      await local.run(syncer.create_remotes,
+                      list(individual_repos_by_branch.keys()), prune_remotes)
+    with metrics.phase("fetch"):
+      await _fetch_individual_repos(syncer, local, remote, fetch_depth,
+                                    fetch_filter, shallow_since)
+    await local.run(_import_fetched, syncer, individual_repos_by_branch,
+                    checkout)
+  if syncer.errors:
+    raise SyncError(syncer.errors, metrics)
+  syncer.logger.info("Done")
+  return metrics
+
+
+async def _fetch_individual_repos(syncer, local, remote, fetch_depth,
+                                  fetch_filter, shallow_since):
+  """Same as `_MonorepoSyncer.fetch_individual_repos`, with the git network
+  operations run by `remote` and the local work by `local`."""
+  unchanged = await _unchanged_upstreams(syncer, local, remote)
+  to_fetch = [
+      individual_repo for individual_repo in syncer.individual_repos
+      if individual_repo.name not in unchanged
+  ]
+  if syncer.mirror_cache:
+    await _update_mirrors(syncer, local, remote, to_fetch)
+  syncer.logger.info("Fetch individual repos...")
+
+  async def fetch(individual_repo):
+    syncer.logger.info("{}: fetching...".format(individual_repo.name))
+    start = time.time()
+    try:
+      (_, progress) = await remote.git(
+          ["fetch"] + syncer._fetch_args(individual_repo, fetch_depth,
+                                         fetch_filter, shallow_since),
+          repo_name = individual_repo.name)
+      syncer.metrics.count_fetch(progress, individual_repo.name)
+    finally:
+      syncer.metrics.add_duration("fetch",
+                                  time.time() - start, individual_repo.name)
+
+  (to_fetch, shallow) = await local.run(syncer._prepare_fetches, to_fetch,
+                                       fetch_depth, fetch_filter,
+                                       shallow_since)
+  results = await _gather(
+      [fetch(individual_repo) for individual_repo in to_fetch])
+  # The shallow fetches run one at a time (see
+  # `_MonorepoSyncer._prepare_fetches`).
+  for individual_repo in shallow:
+    results += await _gather([fetch(individual_repo)])
+  for (individual_repo, (_, error)) in zip(to_fetch + shallow, results):
+    if error:
+      syncer._record_error(individual_repo, error)
+
+
+async def _unchanged_upstreams(syncer, local, remote):
+  """Same as `_MonorepoSyncer._unchanged_upstreams`."""
+  recorded = await local.run(syncer._recorded_upstreams)
+  if not recorded:
+    return set()
+  syncer.logger.info("Check upstream branches...")
+  locations = sorted(recorded.keys())
+
+  async def ls_remote(location):
+    (output, _) = await remote.git(["ls-remote", location] +
+                                   _ls_remote_args(recorded[location]))
+    return _parse_ls_remote(output)
+
+  results = await _gather([ls_remote(location) for location in locations])
+  return syncer._unchanged_upstreams_in(recorded, [
+      (location, remote_refs)
+      for (location, (remote_refs, error)) in zip(locations, results)
+      if not error
+  ])
+
+
+async def _update_mirrors(syncer, local, remote, individual_repos):
+  """Same as `_MonorepoSyncer._update_mirrors`."""
+  syncer.logger.info("Update mirrors...")
+  mirror_cache = syncer.mirror_cache
+  locations = _locations(individual_repos)
+
+  async def update(location):
+    syncer.logger.info("{}: updating mirror...".format(location))
+    path = mirror_cache.mirror_path(location)
+    if os.path.exists(path):
+      await remote.git(["fetch"] + MIRROR_FETCH_ARGS, cwd = path)
+    else:
+      with mirror_cache.new_mirror(path) as temp_path:
+        # Relative locations are relative to the current directory, as
+        # with `git.Repo.clone_from`.
+        await remote.git(["clone", "--mirror", location, temp_path],
+                         cwd = os.getcwd())
+    # The modification time of a mirror is its last use.
+    os.utime(path, None)
+
+  results = await _gather([update(location) for location in locations])
+  for (location, (_, error)) in zip(locations, results):
+    if error:
+      syncer._record_location_error(individual_repos, location, error)
+  await local.run(syncer._evict_mirrors)
+
+
+async def _gather(coroutines):
+  """Same as `common.concurrency.map_in_pool`, for coroutines that run
+  concurrently.  A cancellation is not returned: it cancels all the
+  coroutines.
+
+  Returns:
+    A list of `(result, exception)` pairs, in the same order as
+    `coroutines`.
+  """
+
+  async def call(coroutine):
+    try:
+      return (await coroutine, None)
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      return (None, e)
+
+  return await asyncio.gather(*[call(coroutine) for coroutine in coroutines])
+
+
+class _LocalRunner(object):
+  """Runs the local work of an import on an executor."""
+
+  def __init__(self, executor):
+    self.executor = executor
+
+  async def run(self, fun, *args):
+    """Calls a function on the executor.
+
+    A thread cannot be interrupted: if the call is cancelled, the function
+    still returns before the cancellation propagates, so that the monorepo
+    is not modified concurrently with the next import.
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(self.executor, functools.partial(fun, *args))
+    try:
+      return await asyncio.shield(future)
+    except asyncio.CancelledError:
+      await asyncio.wait([future])
+      raise
+
+
+class _RemoteRunner(object):
+  """Runs the git network operations of an import as asyncio subprocesses.
+
+  Attrs:
+    monorepo: The monorepo, of type `git.Repo`.
+    metrics: The metrics of the import, of type `metrics.Metrics`.
+    timeout: Optional timeout, in seconds, of each git process.
+  """
+
+  def __init__(self, monorepo, metrics, jobs, timeout):
+    self.monorepo = monorepo
+    self.metrics = metrics
+    self.timeout = timeout
+    self._semaphore = asyncio.Semaphore(max(jobs, 1))
+    self._env = dict(os.environ)
+    self._env.update(monorepo.git.environment())
+
+  async def git(self, args, cwd = None, repo_name = None):
+    """Runs a git command, by default in the monorepo.
+
+    Args:
+      args: The arguments of the git command.
+      cwd: Optional working directory of the git command.
+      repo_name: Optional name of the individual repo the command is run
+        for, which the metrics are recorded for.
+    Returns:
+      The `(stdout, stderr)` pair of the git command.
+    Raises:
+      git.GitCommandError: The git command failed or timed out.
+    """
+    command = ["git"] + args
+    async with self._semaphore:
+      self.metrics.increment(GIT_PROCESSES, repo_name = repo_name)
+      process = await asyncio.create_subprocess_exec(
+          *command,
+          cwd = cwd or self.monorepo.working_dir,
+          env = self._env,
+          stdin = subprocess.DEVNULL,
+          stdout = subprocess.PIPE,
+          stderr = subprocess.PIPE)
+      try:
+        (stdout, stderr) = await asyncio.wait_for(process.communicate(),
+                                                  self.timeout)
+      except asyncio.TimeoutError:
+        await _kill(process)
+        raise GitCommandError(command,
+                              "timed out after {}s".format(self.timeout))
+      except asyncio.CancelledError:
+        await _kill(process)
+        raise
+    stdout = stdout.decode("utf-8", "replace")
+    stderr = stderr.decode("utf-8", "replace")
+    if process.returncode != 0:
+      raise GitCommandError(command, process.returncode, stderr, stdout)
+    return (stdout, stderr)
+
+
+async def _kill(process):
+  try:
+    process.kill()
+  except ProcessLookupError:
+    # Already exited
+    pass
+  await process.wait()
@@ -0,0 +1,150 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Unit tests for the `import_into_async` module."""
+import asyncio
+import os
+import shutil
+import time
+import unittest
+from git import Repo
+from monorepo_tools.common.pathutils import onerror
+from monorepo_tools.import_into import (import_into_monorepo,
+                                        import_into_monorepo_async,
+                                        IndividualRepo, SyncError)
+from import_into_test import init_repo1, init_repo2, commit_repo1_2
+from testutils import REPOS_ROOT
+
+#: If `True`, displays the progress reports of the imports.
+DEBUG = False
+
+#: How long the fetches from `_HANGING_LOCATION` hang, in seconds.
+_HANG = 20
+#: A location that git cannot fetch from before `_HANG` seconds.
+_HANGING_LOCATION = "ssh://localhost/hanging"
+
+
+class ImportAsyncTest(unittest.TestCase):
+
+  def setUp(self):
+    if os.path.exists(REPOS_ROOT):
+      shutil.rmtree(REPOS_ROOT, onerror = onerror)
+    os.mkdir(REPOS_ROOT)
+    # Instead of connecting, ssh sleeps.
+    self._git_ssh_command = os.environ.get("GIT_SSH_COMMAND")
+    os.environ["GIT_SSH_COMMAND"] = "sleep {}; true".format(_HANG)
+
+  def tearDown(self):
+    if self._git_ssh_command is None:
+      del os.environ["GIT_SSH_COMMAND"]
+    else:
+      os.environ["GIT_SSH_COMMAND"] = self._git_ssh_command
+
+  def test_same_trees_as_the_blocking_import(self):
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    monorepo1 = Repo.init(os.path.join(REPOS_ROOT, "monorepo1"))
+    import_into_monorepo(
+        monorepo1, [repo1, repo2], "develop", silent = not DEBUG)
+    monorepo2 = Repo.init(os.path.join(REPOS_ROOT, "monorepo2"))
+    metrics = _run(
+        import_into_monorepo_async(
+            monorepo2, [repo1, repo2],
+            "develop",
+            silent = not DEBUG,
+            jobs = 2,
+            mirror_cache_dir = os.path.join(REPOS_ROOT, "mirrors")))
+    self.assertEqual(
+        monorepo2.rev_parse("develop").tree,
+        monorepo1.rev_parse("develop").tree)
+    self.assertGreater(metrics.counters["objects_fetched"], 0)
+    self.assertEqual(
+        list(metrics.repos["repo1"]["phases"].keys()),
+        ["fetch", "move", "merge"])
+
+    commit_repo1_2(repo1)
+    import_into_monorepo(
+        monorepo1, [repo1, repo2], "develop", silent = not DEBUG)
+    metrics = _run(
+        import_into_monorepo_async(
+            monorepo2, [repo1, repo2], "develop", silent = not DEBUG))
+    self.assertEqual(
+        monorepo2.rev_parse("develop").tree,
+        monorepo1.rev_parse("develop").tree)
+    # The upstream branch of repo2 did not move.
+    self.assertNotIn("fetch", metrics.repos["repo2"]["phases"])
+    self.assertIn("fetch", metrics.repos["repo1"]["phases"])
+
+  def test_concurrent_shallow_fetches(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    individual_repos = [
+        IndividualRepo(
+            "file://" + individual_repo.location,
+            individual_repo.branch,
+            name = individual_repo.name)
+        for individual_repo in [init_repo1(), init_repo2()]
+    ]
+    _run(
+        import_into_monorepo_async(
+            monorepo,
+            individual_repos,
+            "develop",
+            silent = not DEBUG,
+            jobs = 2,
+            fetch_depth = 1))
+    self.assertEqual(
+        set(monorepo.git.ls_tree("-r", "--name-only", "develop").split()),
+        set(["repo1/foo.txt", "repo2/bar.txt"]))
+
+  def test_timeouts_do_not_abort_the_import(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    hanging_repo = IndividualRepo(_HANGING_LOCATION, "master")
+    start = time.time()
+    with self.assertRaises(SyncError) as context:
+      _run(
+          import_into_monorepo_async(
+              monorepo, [hanging_repo, repo1],
+              "develop",
+              silent = not DEBUG,
+              jobs = 2,
+              timeout = 2))
+    self.assertLess(time.time() - start, _HANG)
+    self.assertListEqual(list(context.exception.errors.keys()), ["hanging"])
+    self.assertIn("timed out", str(context.exception.errors["hanging"]))
+    self.assertEqual(
+        monorepo.rev_parse("develop:repo1/foo.txt").data_stream.read(),
+        b"FOO")
+
+  def test_cancellation_kills_the_fetches(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    odb = monorepo.odb
+    hanging_repo = IndividualRepo(_HANGING_LOCATION, "master")
+
+    async def cancel_import():
+      task = asyncio.ensure_future(
+          import_into_monorepo_async(
+              monorepo, [hanging_repo], "develop", silent = not DEBUG))
+      await asyncio.sleep(1)
+      task.cancel()
+      await task
+
+    start = time.time()
+    with self.assertRaises(asyncio.CancelledError):
+      _run(cancel_import())
+    self.assertLess(time.time() - start, _HANG)
+    self.assertIs(monorepo.odb, odb)
+    self.assertNotIn("develop", monorepo.heads)
+
+
+def _run(coroutine):
+  loop = asyncio.new_event_loop()
+  try:
+    return loop.run_until_complete(coroutine)
+  finally:
+    loop.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
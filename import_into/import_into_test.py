@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 """Unit tests for the `import_into` module."""
+import collections
 import unittest
 import os
 import re
@@ -10,7 +11,14 @@ import attr
 import shutil
 from git import Repo, Actor, NULL_TREE
 from monorepo_tools.common.pathutils import onerror
-from monorepo_tools.import_into import import_into_monorepo, IndividualRepo
+from monorepo_tools.import_into import (import_into_monorepo,
+                                        import_into_monorepo_branches,
+                                        IndividualRepo, SyncError,
+                                        InitialCommitError,
+                                        ENGINE_WORKTREE, ENGINE_OBJECTS,
+                                        ENGINES, read_manifest)
+from monorepo_tools.import_into.import_into import (
+    _MonorepoSyncer, DEFAULT_AUTHOR, DEFAULT_COMMITTER, DEFAULT_LOGGER_NAME)
 from testutils import (REPOS_ROOT, ExpectedCommits, ExpectedCommit,
                        ExpectedDiff, repo_file, debug_repos)
 
@@ -46,7 +54,9 @@ class ImportTest(unittest.TestCase):
             '<git.Head "refs/heads/individual_repos/develop/repo2">',
             '<git.Head "refs/heads/individual_repos/develop/repo1">',
             '<git.RemoteReference "refs/remotes/repo1/master1">',
-            '<git.Head "refs/heads/master">'
+            '<git.Head "refs/heads/master">',
+            '<git.Reference "refs/monorepo-tools/develop/initial">',
+            '<git.Reference "refs/monorepo-tools/develop/manifest">',
         ]))
     expected_commits = TWO_INDIVIDUAL_REPOS_EXPECTED_COMMITS
     self.assert_commits_equal(
@@ -67,19 +77,227 @@ class ImportTest(unittest.TestCase):
     commit_after = monorepo.rev_parse("develop")
     self.assertEqual(commit_before.hexsha, commit_after.hexsha)
 
+  def test_no_op_import_does_not_touch_the_working_tree(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    repo_file(monorepo, "untracked.txt", "UNTRACKED")
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    self.assertTrue(
+        os.path.exists(os.path.join(monorepo.working_dir, "untracked.txt")))
+    self.assertEqual(monorepo.head.reference.path, "refs/heads/develop")
+
+  def test_remotes_are_updated_in_place(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+
+    moved_location = os.path.join(REPOS_ROOT, "repo1_moved")
+    shutil.move(repo1.location, moved_location)
+    repo1 = IndividualRepo(moved_location, "master1", name = "repo1")
+    commit_repo1_2(repo1)
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    self.assertEqual(monorepo.remote("repo1").url, moved_location)
+    self.assertEqual(
+        monorepo.rev_parse("repo1/master1").message.strip(), "Commit 2")
+    self.assertEqual(
+        set([remote.name for remote in monorepo.remotes]),
+        set(["repo1", "repo2"]))
+
+    import_into_monorepo(
+        monorepo, [repo1], "develop", silent = not DEBUG, prune_remotes = True)
+    self.assertEqual([remote.name for remote in monorepo.remotes], ["repo1"])
+
+  def test_remotes_used_by_other_destination_branches_are_not_pruned(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    for dest_branch_name in ["master", "develop"]:
+      import_into_monorepo(
+          monorepo, [repo1, repo2], dest_branch_name, silent = not DEBUG)
+    import_into_monorepo(
+        monorepo, [repo1], "develop", silent = not DEBUG, prune_remotes = True)
+    # The individual repo branch of master still fetches from repo2.
+    self.assertEqual(
+        set([remote.name for remote in monorepo.remotes]),
+        set(["repo1", "repo2"]))
+    self.assertIn("repo2/master2", [ref.name for ref in monorepo.refs])
+
+    import_into_monorepo_branches(
+        monorepo,
+        collections.OrderedDict([("master", [repo1]), ("develop", [repo1])]),
+        silent = not DEBUG,
+        prune_remotes = True)
+    self.assertEqual([remote.name for remote in monorepo.remotes], ["repo1"])
+
+  def test_mirror_cache_is_shared_between_monorepos(self):
+    mirror_cache_dir = os.path.join(REPOS_ROOT, "mirrors")
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    monorepo1 = Repo.init(os.path.join(REPOS_ROOT, "monorepo1"))
+    import_into_monorepo(
+        monorepo1, [repo1, repo2],
+        "develop",
+        silent = not DEBUG,
+        mirror_cache_dir = mirror_cache_dir)
+    self.assertEqual(len(os.listdir(mirror_cache_dir)), 2)
+    self.assertTrue(
+        monorepo1.remote("repo1").url.startswith(mirror_cache_dir))
+
+    commit_repo1_2(repo1)
+    monorepo2 = Repo.init(os.path.join(REPOS_ROOT, "monorepo2"))
+    import_into_monorepo(
+        monorepo2, [repo1],
+        "develop",
+        silent = not DEBUG,
+        mirror_cache_dir = mirror_cache_dir,
+        mirror_cache_max_size = 0)
+    # The mirror of repo2 is evicted, but the mirror of repo1 is in use.
+    self.assertEqual(len(os.listdir(mirror_cache_dir)), 1)
+    self.assertSetEqual(
+        set([
+            blob.path
+            for blob in monorepo2.rev_parse("develop").tree.traverse()
+            if blob.type == "blob"
+        ]), set(["repo1/foo.txt", "repo1/qux.txt"]))
+
+  def test_unchanged_upstreams_are_not_fetched(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    fetch_head = os.path.join(monorepo.git_dir, "FETCH_HEAD")
+    os.remove(fetch_head)
+
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    self.assertFalse(os.path.exists(fetch_head))
+
+    commit_repo1_2(repo1)
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    self.assertTrue(os.path.exists(fetch_head))
+    self.assertEqual(
+        monorepo.rev_parse("develop:repo1/qux.txt").data_stream.read(), b"QUX")
+
+  def test_manifest_records_the_imported_commits(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+    manifest = read_manifest(monorepo, "develop")
+    self.assertEqual(manifest["dest_commit"],
+                     monorepo.rev_parse("develop").hexsha)
+    self.assertEqual(sorted(manifest["individual_repos"].keys()),
+                     ["repo1", "repo2"])
+    entry = manifest["individual_repos"]["repo1"]
+    self.assertEqual(entry["location"], repo1.location)
+    self.assertEqual(entry["branch"], "master1")
+    self.assertEqual(entry["destination"], "repo1")
+    self.assertEqual(entry["upstream_commit"],
+                     Repo(repo1.location).rev_parse("master1").hexsha)
+    self.assertEqual(
+        entry["individual_repo_commit"],
+        monorepo.rev_parse("individual_repos/develop/repo1").hexsha)
+    manifest_commit = monorepo.rev_parse("refs/monorepo-tools/develop/manifest")
+
+    # A no-op import does not change the manifest.
+    import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+    self.assertEqual(
+        monorepo.rev_parse("refs/monorepo-tools/develop/manifest"),
+        manifest_commit)
+
+    commit_repo1_2(repo1)
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    self.assertEqual(
+        monorepo.rev_parse("refs/monorepo-tools/develop/manifest").parents,
+        (manifest_commit,))
+    manifest = read_manifest(monorepo, "develop")
+    self.assertEqual(list(manifest["individual_repos"].keys()), ["repo1"])
+    self.assertEqual(manifest["individual_repos"]["repo1"]["upstream_commit"],
+                     Repo(repo1.location).rev_parse("master1").hexsha)
+    self.assertIsNone(read_manifest(monorepo, "other"))
+
+  def test_initial_commit_is_found_without_its_ref(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    initial_commit = monorepo.rev_parse("refs/monorepo-tools/develop/initial")
+    self.assertEqual(initial_commit.message, "Initial monorepo commit")
+
+    # Monorepos imported before the initial commit was recorded
+    monorepo.git.update_ref("-d", "refs/monorepo-tools/develop/initial")
+    repo2 = init_repo2()
+    import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+    self.assertEqual(
+        monorepo.rev_parse("refs/monorepo-tools/develop/initial"),
+        initial_commit)
+    self.assertIn(
+        initial_commit,
+        monorepo.rev_parse("individual_repos/develop/repo2~1").parents)
+
+  def test_initial_commit_on_top_of_existing_history(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo_file(monorepo, "README.md", "README")
+    monorepo.index.add([os.path.join(monorepo.working_dir, "README.md")])
+    existing_commit = monorepo.index.commit("Existing commit")
+    repo1 = init_repo1()
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    initial_commit = monorepo.rev_parse("refs/monorepo-tools/develop/initial")
+    self.assertEqual(initial_commit.parents, (existing_commit,))
+
+    # Monorepos imported before the initial commit was recorded
+    monorepo.git.update_ref("-d", "refs/monorepo-tools/develop/initial")
+    repo2 = init_repo2()
+    import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+    self.assertEqual(
+        monorepo.rev_parse("refs/monorepo-tools/develop/initial"),
+        initial_commit)
+
+  def test_initial_commit_not_found(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo_file(monorepo, "README.md", "README")
+    monorepo.index.add([os.path.join(monorepo.working_dir, "README.md")])
+    monorepo.create_head("develop", monorepo.index.commit("Existing commit"))
+    with self.assertRaises(InitialCommitError):
+      import_into_monorepo(
+          monorepo, [init_repo1()], "develop", silent = not DEBUG)
+
+  def test_metrics_are_recorded(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    git = monorepo.git
+    metrics = import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+    self.assertIs(monorepo.git, git)
+    self.assertEqual(
+        list(metrics.phases.keys()),
+        ["create_remotes", "fetch", "move", "merge", "cleanup", "manifest"])
+    self.assertEqual(metrics.counters["merges"], 2)
+    self.assertEqual(metrics.counters["files_moved"], 2)
+    self.assertGreater(metrics.counters["objects_fetched"], 0)
+    self.assertGreater(metrics.counters["git_processes"], 0)
+    self.assertEqual(set(metrics.repos.keys()), set(["repo1", "repo2"]))
+    self.assertEqual(
+        list(metrics.repos["repo1"]["phases"].keys()),
+        ["fetch", "move", "merge"])
+    self.assertEqual(metrics.repos["repo1"]["counters"]["files_moved"], 1)
+
+    metrics = import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+    self.assertNotIn("merges", metrics.counters)
+    self.assertNotIn("objects_fetched", metrics.counters)
+
   def test_incremental_merge_if_the_individual_repo_changed(self):
     monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
     repo1 = init_repo1()
     import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
 
-    repo1_git = Repo(repo1.location)
-    repo_file(repo1_git, "qux.txt", "QUX")
-    repo1_git.index.add([os.path.join(repo1_git.working_dir, "qux.txt")])
-    commit = repo1_git.index.commit(
-        "Commit 2",
-        committer = Actor("Committer2", "committer2@domain.test"),
-        author = Actor("Author2", "author1@domain.test"))
-    repo1_git.heads["master1"].commit = commit
+    commit_repo1_2(repo1)
 
     import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
 
@@ -103,6 +321,335 @@ class ImportTest(unittest.TestCase):
     self.assertEqual(
         expected_commits.match_head(monorepo, "develop"), "MERGE_MOVED_REPO2")
 
+  def test_interrupted_merges_are_resumed(self):
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    for engine in ENGINES:
+      monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo_" + engine))
+      # The import is interrupted before the merges.
+      syncer = _MonorepoSyncer(monorepo, [repo1, repo2], DEFAULT_AUTHOR,
+                               DEFAULT_COMMITTER, DEFAULT_LOGGER_NAME, engine)
+      syncer.create_remotes(["develop"])
+      syncer.create_or_update_individual_repo_branches(
+          "develop", syncer.fetch_individual_repos())
+      self.assertNotIn("develop", monorepo.heads)
+
+      import_into_monorepo(
+          monorepo, [repo1, repo2],
+          "develop",
+          silent = not DEBUG,
+          engine = engine)
+      expected_commits = TWO_INDIVIDUAL_REPOS_EXPECTED_COMMITS
+      self.assert_commits_equal(
+          expected_commits,
+          [commit for commit in monorepo.iter_commits("develop")])
+      self.assertEqual(
+          expected_commits.match_head(monorepo, "develop"),
+          "MERGE_MOVED_REPO2")
+
+  def test_interrupted_move_is_resumed(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    # The import is interrupted after the upstream history of repo2 is
+    # merged, while its files are moved.
+    syncer = _MonorepoSyncer(monorepo, [repo1, repo2], DEFAULT_AUTHOR,
+                             DEFAULT_COMMITTER, DEFAULT_LOGGER_NAME)
+    syncer.create_remotes(["develop"])
+    syncer.create_or_update_individual_repo_branches(
+        "develop", syncer.fetch_individual_repos())
+    repo2_branch = monorepo.heads["individual_repos/develop/repo2"]
+    repo2_branch.commit = repo2_branch.commit.parents[0]
+    repo2_branch.checkout(force = True)
+    os.renames(
+        os.path.join(monorepo.working_dir, "bar.txt"),
+        os.path.join(monorepo.working_dir, "repo2", "bar.txt"))
+
+    import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+    expected_commits = TWO_INDIVIDUAL_REPOS_EXPECTED_COMMITS
+    self.assert_commits_equal(
+        expected_commits,
+        [commit for commit in monorepo.iter_commits("develop")])
+    self.assertEqual(monorepo.head.reference.path, "refs/heads/develop")
+    self.assertFalse(monorepo.is_dirty(untracked_files = True))
+
+  def test_several_destination_branches_in_one_pass(self):
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    for engine in ENGINES:
+      monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo_" + engine))
+      metrics = import_into_monorepo_branches(
+          monorepo,
+          collections.OrderedDict([("develop", [repo1, repo2]),
+                                   ("release", [repo1, repo2]),
+                                   ("legacy", [repo2])]),
+          silent = not DEBUG,
+          engine = engine)
+      for dest_branch_name in ["develop", "release"]:
+        self.assert_commits_equal(
+            TWO_INDIVIDUAL_REPOS_EXPECTED_COMMITS,
+            [commit for commit in monorepo.iter_commits(dest_branch_name)])
+      self.assertEqual(
+          [entry.name for entry in monorepo.rev_parse("legacy^{tree}")],
+          ["repo2"])
+      # The upstream branches are fetched once, and the individual repo
+      # branches share their moves.
+      # (a commit, a tree and a blob for each individual repo)
+      self.assertEqual(metrics.counters["objects_fetched"], 6)
+      for repo_name in ["repo1", "repo2"]:
+        self.assertEqual(
+            monorepo.rev_parse("individual_repos/develop/" + repo_name),
+            monorepo.rev_parse("individual_repos/release/" + repo_name))
+      if engine == ENGINE_WORKTREE:
+        # The moves into "legacy", that has other individual repos, depend
+        # on their destinations and are not reused.
+        self.assertEqual(metrics.counters["files_moved"], 3)
+      self.assertEqual(metrics.counters["merges"], 5)
+      self.assertEqual(monorepo.head.reference.path, "refs/heads/develop")
+      self.assertFalse(monorepo.is_dirty(untracked_files = True))
+      for dest_branch_name in ["develop", "release", "legacy"]:
+        self.assertIsNotNone(read_manifest(monorepo, dest_branch_name))
+
+    with self.assertRaises(ValueError):
+      import_into_monorepo_branches(
+          monorepo, {
+              "develop": [repo1],
+              "release": [IndividualRepo(repo2.location, "master2", "repo1")]
+          },
+          silent = not DEBUG)
+
+  def test_shallow_and_partial_fetches(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    commit_repo1_2(repo1)
+    repo1_git = Repo(repo1.location)
+    with repo1_git.config_writer() as writer:
+      writer.set_value("uploadpack", "allowFilter", "true")
+    repo1 = IndividualRepo(
+        "file://" + repo1.location,
+        "master1",
+        name = "repo1",
+        fetch_depth = 1,
+        fetch_filter = "blob:none")
+    import_into_monorepo(monorepo, [repo1], "develop", silent = not DEBUG)
+    self.assertEqual(monorepo.git.rev_list("--count", "repo1/master1"), "1")
+    self.assertTrue(os.path.exists(os.path.join(monorepo.git_dir, "shallow")))
+    self.assertEqual(
+        monorepo.config_reader().get_value('remote "repo1"', "promisor"), True)
+    # The blobs are fetched on demand.
+    self.assertEqual(
+        set(os.listdir(os.path.join(monorepo.working_dir, "repo1"))),
+        set(["foo.txt", "qux.txt"]))
+
+  def test_partial_fetch_filter_can_be_removed(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    with Repo(repo1.location).config_writer() as writer:
+      writer.set_value("uploadpack", "allowFilter", "true")
+    location = "file://" + repo1.location
+    import_into_monorepo(
+        monorepo,
+        [IndividualRepo(location, "master1", name = "repo1")],
+        "develop",
+        silent = not DEBUG,
+        fetch_filter = "blob:none")
+    section = 'remote "repo1"'
+    self.assertEqual(
+        monorepo.config_reader().get_value(section, "partialclonefilter"),
+        "blob:none")
+
+    # The upstream branch did not move.
+    import_into_monorepo(
+        monorepo, [IndividualRepo(location, "master1", name = "repo1")],
+        "develop",
+        silent = not DEBUG)
+    reader = monorepo.config_reader()
+    self.assertFalse(reader.has_option(section, "promisor"))
+    self.assertFalse(reader.has_option(section, "partialclonefilter"))
+
+  def test_concurrent_shallow_fetches(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    individual_repos = []
+    for i in range(8):
+      repo = Repo.init(os.path.join(REPOS_ROOT, "repo{}".format(i)))
+      repo_file(repo, "foo.txt", "FOO{}".format(i))
+      repo.index.add([os.path.join(repo.working_dir, "foo.txt")])
+      repo.index.commit("Commit {}".format(i))
+      individual_repos.append(
+          IndividualRepo(
+              "file://" + repo.working_dir,
+              "master",
+              name = "repo{}".format(i)))
+    import_into_monorepo(
+        monorepo,
+        individual_repos,
+        "develop",
+        silent = not DEBUG,
+        jobs = 8,
+        fetch_depth = 1)
+    self.assertEqual(
+        monorepo.rev_parse("develop:repo7/foo.txt").data_stream.read(),
+        b"FOO7")
+
+  def test_shallow_imports_after_upstream_commits(self):
+    for engine in ENGINES:
+      repo1_git = Repo.init(os.path.join(REPOS_ROOT, "repo1_" + engine))
+      repo_file(repo1_git, "foo.txt", "FOO")
+      repo1_git.index.add([os.path.join(repo1_git.working_dir, "foo.txt")])
+      repo1_git.create_head("master1", repo1_git.index.commit("Commit 1"))
+      repo1 = IndividualRepo(
+          "file://" + repo1_git.working_dir,
+          "master1",
+          name = "repo1",
+          fetch_depth = 1)
+      monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo_" + engine))
+      import_into_monorepo(
+          monorepo, [repo1], "develop", silent = not DEBUG, engine = engine)
+      # The new commit adds a file, the next one deletes another.
+      commit_repo1_2(IndividualRepo(repo1_git.working_dir, "master1"))
+      import_into_monorepo(
+          monorepo, [repo1], "develop", silent = not DEBUG, engine = engine)
+      repo1_git.index.remove(["foo.txt"], working_tree = True)
+      repo1_git.heads["master1"].commit = repo1_git.index.commit("Commit 3")
+      import_into_monorepo(
+          monorepo, [repo1], "develop", silent = not DEBUG, engine = engine)
+      self.assertEqual(
+          set([
+              blob.path
+              for blob in monorepo.rev_parse("develop").tree.traverse()
+              if blob.type == "blob"
+          ]), set(["repo1/qux.txt"]), engine)
+      self.assertEqual(monorepo.head.reference.path, "refs/heads/develop",
+                       engine)
+
+  def test_objects_engine_creates_the_same_commits(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    import_into_monorepo(
+        monorepo, [repo1, repo2],
+        "develop",
+        silent = not DEBUG,
+        engine = ENGINE_OBJECTS)
+
+    commits = [commit for commit in monorepo.iter_commits("develop")]
+    expected_commits = TWO_INDIVIDUAL_REPOS_EXPECTED_COMMITS
+    self.assert_commits_equal(expected_commits, commits)
+    self.assertEqual(
+        expected_commits.match_head(monorepo, "develop"), "MERGE_MOVED_REPO2")
+
+  def test_bare_monorepo(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"), bare = True)
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+
+    commits = [commit for commit in monorepo.iter_commits("develop")]
+    expected_commits = TWO_INDIVIDUAL_REPOS_EXPECTED_COMMITS
+    self.assert_commits_equal(expected_commits, commits)
+    self.assertEqual(
+        expected_commits.match_head(monorepo, "develop"), "MERGE_MOVED_REPO2")
+
+    commit_repo1_2(repo1)
+    import_into_monorepo(
+        monorepo, [repo1, repo2], "develop", silent = not DEBUG)
+    self.assertEqual(
+        monorepo.rev_parse("develop:repo1/qux.txt").data_stream.read(), b"QUX")
+    with self.assertRaises(ValueError):
+      import_into_monorepo(
+          monorepo, [repo1, repo2],
+          "develop",
+          silent = not DEBUG,
+          engine = ENGINE_WORKTREE)
+
+  def test_objects_engine_creates_the_same_trees_incrementally(self):
+    monorepos = {
+        engine: Repo.init(os.path.join(REPOS_ROOT, "monorepo_" + engine))
+        for engine in ENGINES
+    }
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    for engine, monorepo in monorepos.items():
+      import_into_monorepo(
+          monorepo, [repo1], "develop", silent = not DEBUG, engine = engine)
+    commit_repo1_2(repo1)
+    for engine, monorepo in monorepos.items():
+      import_into_monorepo(
+          monorepo, [repo1, repo2],
+          "develop",
+          silent = not DEBUG,
+          engine = engine)
+
+    for rev in [
+        "develop", "individual_repos/develop/repo1",
+        "individual_repos/develop/repo2"
+    ]:
+      self.assertEqual(
+          monorepos[ENGINE_WORKTREE].rev_parse(rev).tree.hexsha,
+          monorepos[ENGINE_OBJECTS].rev_parse(rev).tree.hexsha,
+          "unexpected tree for {}".format(rev))
+    self.assertEqual(
+        len(list(monorepos[ENGINE_WORKTREE].iter_commits("develop"))),
+        len(list(monorepos[ENGINE_OBJECTS].iter_commits("develop"))))
+
+  def test_objects_engine_can_skip_the_checkout(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    import_into_monorepo(
+        monorepo, [repo1, repo2],
+        "develop",
+        silent = not DEBUG,
+        engine = ENGINE_OBJECTS,
+        checkout = False)
+
+    self.assertListEqual(os.listdir(monorepo.working_dir), [".git"])
+    self.assertEqual(monorepo.head.reference.path, "refs/heads/master")
+    self.assertSetEqual(
+        set([
+            blob.path
+            for blob in monorepo.rev_parse("develop").tree.traverse()
+            if blob.type == "blob"
+        ]), set(["repo1/foo.txt", "repo2/bar.txt"]))
+
+  def test_fetch_failures_do_not_abort_the_import(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    repo1 = init_repo1()
+    repo2 = init_repo2()
+    missing_repo = IndividualRepo(
+        os.path.join(REPOS_ROOT, "missing"), "master", name = "missing")
+    with self.assertRaises(SyncError) as context:
+      import_into_monorepo(
+          monorepo, [repo1, missing_repo, repo2],
+          "develop",
+          silent = not DEBUG,
+          jobs = 3)
+    self.assertListEqual(list(context.exception.errors.keys()), ["missing"])
+
+    commits = [commit for commit in monorepo.iter_commits("develop")]
+    expected_commits = TWO_INDIVIDUAL_REPOS_EXPECTED_COMMITS
+    self.assert_commits_equal(expected_commits, commits)
+
+  def test_nested_directories_are_moved(self):
+    repo3 = init_repo3()
+    for engine in ENGINES:
+      monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo_" + engine))
+      import_into_monorepo(
+          monorepo, [repo3], "develop", silent = not DEBUG, engine = engine)
+      self.assertSetEqual(
+          set([
+              blob.path
+              for blob in monorepo.rev_parse("develop").tree.traverse()
+              if blob.type == "blob"
+          ]),
+          set([
+              "packages/repo3/e.txt", "packages/repo3/a/d.txt",
+              "packages/repo3/a/b/c.txt"
+          ]), "unexpected files for {}".format(engine))
+
   def assert_commits_equal(self, expected_commits, actual_commits):
     # The number of commits must be the same
     self.assertEqual(len(expected_commits.commits), len(actual_commits))
@@ -186,6 +733,32 @@ def init_repo2():
   return IndividualRepo(repo.working_dir, "master2")
 
 
+def init_repo3():
+  repo = Repo.init(os.path.join(REPOS_ROOT, "repo3"))
+  os.makedirs(os.path.join(repo.working_dir, "a", "b"))
+  for filename in ["e.txt", "a/d.txt", "a/b/c.txt"]:
+    repo_file(repo, filename, filename.upper())
+    repo.index.add([os.path.join(repo.working_dir, filename)])
+  commit = repo.index.commit(
+      "Commit 3",
+      committer = Actor("Committer3", "committer3@domain.test"),
+      author = Actor("Author3", "author3@domain.test"))
+  repo.create_head("master3", commit)
+  return IndividualRepo(
+      repo.working_dir, "master3", destination = "packages/repo3")
+
+
+def commit_repo1_2(repo1):
+  repo1_git = Repo(repo1.location)
+  repo_file(repo1_git, "qux.txt", "QUX")
+  repo1_git.index.add([os.path.join(repo1_git.working_dir, "qux.txt")])
+  commit = repo1_git.index.commit(
+      "Commit 2",
+      committer = Actor("Committer2", "committer2@domain.test"),
+      author = Actor("Author2", "author1@domain.test"))
+  repo1_git.heads["master1"].commit = commit
+
+
 TWO_INDIVIDUAL_REPOS_EXPECTED_COMMITS = ExpectedCommits({
     "INIT_MONOREPO":
         ExpectedCommit(
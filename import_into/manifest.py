@@ -0,0 +1,94 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Manifest of the individual repos imported into a destination branch.
+
+The manifest is a JSON file, `manifest.json`, at the root of the tree of a
+commit pointed to by `refs/monorepo-tools/<dest branch>/manifest`.  Each
+import that changes the manifest creates a new manifest commit on top of
+the previous one, so that the history of the imports can be audited.
+
+The manifest looks like:
+
+```
+{
+  "version": 1,
+  "dest_branch": "master",
+  "dest_commit": "<SHA1 of the destination branch>",
+  "individual_repos": {
+    "<name>": {
+      "location": "https://github.com/orga/repo.git",
+      "branch": "master",
+      "destination": "repo",
+      "upstream_commit": "<SHA1 of the imported upstream branch>",
+      "individual_repo_commit": "<SHA1 of the individual repo branch>"
+    }
+  }
+}
+```
+"""
+import json
+from io import BytesIO
+from gitdb.base import IStream
+from git import Reference, SymbolicReference
+from git.objects import Commit, Tree
+from monorepo_tools.import_into.trees import write_tree
+
+MANIFEST_VERSION = 1
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_COMMIT_MESSAGE = "Update import manifest"
+_BLOB_MODE = 0o100644
+
+
+def manifest_ref_name(dest_branch_name):
+  return "refs/monorepo-tools/{}/manifest".format(dest_branch_name)
+
+
+def read_manifest(repo, dest_branch_name):
+  """Reads the manifest of a destination branch.
+
+  Args:
+    repo: The monorepo, of type `git.Repo`.
+    dest_branch_name: The destination branch.
+  Returns:
+    The manifest, as a dictionary, or `None` if there is no manifest for
+    this destination branch.
+  """
+  try:
+    hexsha = SymbolicReference.dereference_recursive(
+        repo, manifest_ref_name(dest_branch_name))
+  except ValueError:
+    return None
+  blob = repo.commit(hexsha).tree / MANIFEST_FILENAME
+  return json.loads(blob.data_stream.read().decode("utf-8"))
+
+
+def write_manifest(repo, dest_branch_name, manifest, author, committer):
+  """Writes the manifest of a destination branch.  No commit is created if
+  the manifest did not change.
+
+  Returns:
+    The manifest commit, of type `git.Commit`.
+  """
+  data = json.dumps(manifest, indent = 2, sort_keys = True).encode("utf-8")
+  blob_binsha = repo.odb.store(IStream("blob", len(data),
+                                       BytesIO(data))).binsha
+  tree_binsha = write_tree(repo, [(blob_binsha, _BLOB_MODE, MANIFEST_FILENAME)])
+  ref = Reference(repo, manifest_ref_name(dest_branch_name))
+  parents = []
+  if ref.is_valid():
+    if ref.commit.tree.binsha == tree_binsha:
+      return ref.commit
+    parents = [ref.commit]
+  commit = Commit.create_from_tree(
+      repo,
+      Tree(repo, tree_binsha),
+      MANIFEST_COMMIT_MESSAGE,
+      parent_commits = parents,
+      head = False,
+      author = author,
+      committer = committer)
+  Reference.create(
+      repo, manifest_ref_name(dest_branch_name), commit, force = True)
+  return commit
@@ -0,0 +1,145 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Structured metrics of the import algorithms: durations of the phases,
+and counters, globally and for each individual repo."""
+import collections
+import contextlib
+import json
+import re
+import threading
+import time
+from git import Git
+
+#: Counter of the git processes spawned through `git.Repo.git`.
+GIT_PROCESSES = "git_processes"
+#: Counter of the objects received by `git fetch`.
+OBJECTS_FETCHED = "objects_fetched"
+#: Counter of the bytes received by `git fetch`.
+BYTES_FETCHED = "bytes_fetched"
+#: Counter of the files moved to the destination folder of their individual
+#: repo.
+FILES_MOVED = "files_moved"
+#: Counter of the individual repos merged into the destination branch.
+MERGES = "merges"
+
+_FETCH_TOTAL_RE = re.compile(r"Total (\d+)")
+_FETCH_SIZE_RE = re.compile(r"(?:Receiving|Unpacking) objects:\s+100% " +
+                            r"\(\d+/\d+\),\s*([\d.]+)\s*(bytes|KiB|MiB|GiB)")
+_UNITS = {"bytes": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3}
+
+
+class Metrics(object):
+  """Durations and counters recorded during an import.
+
+  Metrics can be recorded concurrently from many threads.
+
+  Attrs:
+    phases: Ordered dictionary of phase names to their duration, in
+      seconds.
+    counters: Ordered dictionary of counter names to their value.
+    repos: Ordered dictionary of individual repo names to a dictionary
+      with `phases` and `counters` keys, for the work done on behalf of
+      this individual repo only.
+  """
+
+  def __init__(self):
+    self.phases = collections.OrderedDict()
+    self.counters = collections.OrderedDict()
+    self.repos = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  @contextlib.contextmanager
+  def phase(self, name, repo_name = None):
+    """Context manager that times a phase, globally or, if `repo_name` is
+    given, for an individual repo.  Within the context, counters are by
+    default incremented for this individual repo too."""
+    previous_repo_name = self._current_repo_name()
+    if repo_name:
+      self._local.repo_name = repo_name
+    start = time.time()
+    try:
+      yield
+    finally:
+      self._local.repo_name = previous_repo_name
+      self.add_duration(name, time.time() - start, repo_name)
+
+  def add_duration(self, name, elapsed, repo_name = None):
+    """Adds to the duration of a phase, globally or, if `repo_name` is
+    given, for an individual repo.  For the phases that `phase` cannot
+    time, such as the ones of coroutines that interleave on one thread."""
+    with self._lock:
+      phases = self._repo(repo_name)["phases"] if repo_name else self.phases
+      phases[name] = phases.get(name, 0) + elapsed
+
+  def increment(self, name, value = 1, repo_name = None):
+    """Increments a counter, globally and for an individual repo.  The
+    individual repo is by default the one of the current phase."""
+    repo_name = repo_name or self._current_repo_name()
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+      if repo_name:
+        counters = self._repo(repo_name)["counters"]
+        counters[name] = counters.get(name, 0) + value
+
+  def count_fetch(self, progress, repo_name = None):
+    """Increments the fetch counters from the progress output of
+    `git fetch --progress`.  Git does not report the size of the smallest
+    transfers."""
+    totals = _FETCH_TOTAL_RE.findall(progress)
+    if totals:
+      self.increment(OBJECTS_FETCHED, int(totals[-1]), repo_name)
+    sizes = _FETCH_SIZE_RE.findall(progress)
+    if sizes:
+      (size, unit) = sizes[-1]
+      self.increment(BYTES_FETCHED, int(float(size) * _UNITS[unit]),
+                     repo_name)
+
+  def to_dict(self):
+    return collections.OrderedDict([
+        ("phases", self.phases),
+        ("counters", self.counters),
+        ("repos", self.repos),
+    ])
+
+  def to_json(self):
+    return json.dumps(self.to_dict(), indent = 2)
+
+  def _current_repo_name(self):
+    return getattr(self._local, "repo_name", None)
+
+  def _repo(self, repo_name):
+    if repo_name not in self.repos:
+      self.repos[repo_name] = collections.OrderedDict([
+          ("phases", collections.OrderedDict()),
+          ("counters", collections.OrderedDict()),
+      ])
+    return self.repos[repo_name]
+
+
+@contextlib.contextmanager
+def count_git_processes(repo, metrics):
+  """Context manager that counts, in the `GIT_PROCESSES` counter, the git
+  processes spawned through `repo.git`, which is where GitPython spawns
+  all its processes."""
+  original_git = repo.git
+  repo.git = _CountingGit(repo.working_dir, metrics)
+  repo.git.update_environment(**original_git.environment())
+  try:
+    yield
+  finally:
+    repo.git.clear_cache()
+    repo.git = original_git
+
+
+class _CountingGit(Git):
+
+  def __init__(self, working_dir, metrics):
+    super(_CountingGit, self).__init__(working_dir)
+    self.metrics = metrics
+
+  def execute(self, *args, **kwargs):
+    self.metrics.increment(GIT_PROCESSES)
+    return super(_CountingGit, self).execute(*args, **kwargs)
@@ -0,0 +1,125 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Persistent cache of bare mirrors of individual repos.
+
+A mirror cache can be shared by many monorepos and destination branches:
+the monorepos fetch from the mirrors, so that the objects of an individual
+repo are transferred over the network once per cache instead of once per
+monorepo and destination branch.
+"""
+import contextlib
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from git import Git, Repo
+from monorepo_tools.common.pathutils import onerror
+
+#: Arguments of the `git fetch` that updates an existing mirror.
+MIRROR_FETCH_ARGS = ["--prune", "origin"]
+
+
+class MirrorCache(object):
+  """A directory of bare mirrors, one per individual repo location.
+
+  Attrs:
+    path: The directory of the cache.  It is created if it does not exist.
+    max_size: The maximum size of the cache, in bytes, or `None` for no
+      limit.  See `MirrorCache.evict`.
+  """
+
+  def __init__(self, path, max_size = None):
+    self.path = os.path.abspath(os.path.expanduser(path))
+    self.max_size = max_size
+    if not os.path.exists(self.path):
+      os.makedirs(self.path)
+
+  def mirror_path(self, location):
+    """Gets the path of the mirror of an individual repo location."""
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_",
+                  location.rstrip("/\\").split("/")[-1].split("\\")[-1])
+    if name.endswith(".git"):
+      name = name[:-len(".git")]
+    digest = hashlib.sha1(location.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(self.path, "{}-{}.git".format(name, digest))
+
+  def update(self, location):
+    """Creates or updates the mirror of an individual repo location.
+
+    Returns:
+      The path of the mirror.
+    """
+    path = self.mirror_path(location)
+    if os.path.exists(path):
+      Git(path).fetch(*MIRROR_FETCH_ARGS)
+    else:
+      with self.new_mirror(path) as temp_path:
+        Repo.clone_from(location, temp_path, mirror = True)
+    # The modification time of a mirror is its last use.
+    os.utime(path, None)
+    return path
+
+  @contextlib.contextmanager
+  def new_mirror(self, path):
+    """Context manager for the creation of the mirror at `path`.  The
+    mirror must be cloned, with `--mirror`, into the temporary directory
+    that the context yields.
+
+    Cloning next to the final location then renaming makes the creation
+    atomic for concurrent users of the cache.
+    """
+    temp_path = tempfile.mkdtemp(dir = self.path, prefix = ".tmp-")
+    try:
+      yield temp_path
+      mirror = Repo(temp_path)
+      # So that monorepos can fetch from the mirror with a filter, for a
+      # partial clone.
+      with mirror.config_writer() as writer:
+        writer.set_value("uploadpack", "allowFilter", "true")
+      mirror.close()
+      if not os.path.exists(path):
+        os.rename(temp_path, path)
+    finally:
+      if os.path.exists(temp_path):
+        shutil.rmtree(temp_path, onerror = onerror)
+
+  def evict(self, keep = ()):
+    """Deletes the least recently used mirrors until the size of the cache
+    is below `max_size`.
+
+    Args:
+      keep: Paths of the mirrors that must not be deleted, whatever their
+        last use.
+    Returns:
+      The paths of the mirrors that were deleted.
+    """
+    if self.max_size is None:
+      return []
+    keep = set([os.path.abspath(path) for path in keep])
+    mirrors = []
+    for entry in os.listdir(self.path):
+      path = os.path.join(self.path, entry)
+      if entry.endswith(".git") and os.path.isdir(path):
+        mirrors.append((os.path.getmtime(path), path, _dir_size(path)))
+    total_size = sum([size for (_, _, size) in mirrors])
+    evicted = []
+    for (_, path, size) in sorted(mirrors):
+      if total_size <= self.max_size:
+        break
+      if path in keep:
+        continue
+      shutil.rmtree(path, onerror = onerror)
+      total_size -= size
+      evicted.append(path)
+    return evicted
+
+
+def _dir_size(path):
+  size = 0
+  for (dirpath, _, filenames) in os.walk(path):
+    for filename in filenames:
+      size += os.lstat(os.path.join(dirpath, filename)).st_size
+  return size
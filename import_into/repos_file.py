@@ -0,0 +1,136 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Declarative list of the individual repos to import.
+
+A repos file is a JSON file that looks like:
+
+```
+{
+  "version": 1,
+  "individual_repos": [
+    {
+      "location": "https://github.com/reduxjs/redux.git",
+      "branch": "v4.0.4",
+      "name": "redux",
+      "destination": "packages/redux/core",
+      "fetch_filter": "blob:none",
+      "dest_branches": ["master"]
+    }
+  ]
+}
+```
+
+Only `location` and `branch` are required.  The other fields are the
+options of `IndividualRepo`, and `dest_branches` restricts the destination
+branches the individual repo is imported into (by default, all of them).
+Unlike a Python module, a repos file can be validated without running any
+code.
+"""
+import json
+from monorepo_tools.import_into.import_into import IndividualRepo
+
+REPOS_FILE_VERSION = 1
+
+_STRING = (type(u""), str)
+#: Type of each field of an individual repo, and whether it is required.
+_FIELDS = {
+    "location": (_STRING, True),
+    "branch": (_STRING, True),
+    "name": (_STRING, False),
+    "destination": (_STRING, False),
+    "fetch_depth": (int, False),
+    "fetch_filter": (_STRING, False),
+    "shallow_since": (_STRING, False),
+    "dest_branches": (list, False),
+}
+
+
+class ReposFileError(ValueError):
+  """Error raised when a repos file is invalid."""
+
+
+def load_individual_repos(path, dest_branch_name):
+  """Loads the individual repos to import into a destination branch from a
+  repos file.
+
+  Args:
+    path: The path to the repos file.
+    dest_branch_name: The destination branch.
+  Returns:
+    A list of `IndividualRepo`.
+  Raises:
+    ReposFileError: The repos file is invalid.
+  """
+  with open(path) as f:
+    try:
+      data = json.load(f)
+    except ValueError as e:
+      raise ReposFileError("{}: invalid JSON: {}".format(path, e))
+  try:
+    return parse_individual_repos(data, dest_branch_name)
+  except ReposFileError as e:
+    raise ReposFileError("{}: {}".format(path, e))
+
+
+def parse_individual_repos(data, dest_branch_name):
+  """Same as `load_individual_repos`, for the decoded content of a repos
+  file."""
+  if not isinstance(data, dict):
+    raise ReposFileError("expected an object")
+  _check_keys(data, ["version", "individual_repos"], "repos file")
+  if data.get("version") != REPOS_FILE_VERSION:
+    raise ReposFileError("unsupported version {!r}; expected {}".format(
+        data.get("version"), REPOS_FILE_VERSION))
+  entries = data.get("individual_repos")
+  if not isinstance(entries, list):
+    raise ReposFileError("'individual_repos' must be a list")
+  individual_repos = []
+  names = set()
+  for (i, entry) in enumerate(entries):
+    individual_repo = _parse_entry(entry, "individual_repos[{}]".format(i))
+    if individual_repo.name in names:
+      raise ReposFileError("duplicate individual repo '{}'".format(
+          individual_repo.name))
+    names.add(individual_repo.name)
+    dest_branches = entry.get("dest_branches")
+    if dest_branches is None or dest_branch_name in dest_branches:
+      individual_repos.append(individual_repo)
+  return individual_repos
+
+
+def _parse_entry(entry, context):
+  if not isinstance(entry, dict):
+    raise ReposFileError("{}: expected an object".format(context))
+  _check_keys(entry, _FIELDS.keys(), context)
+  for (field, (field_type, required)) in _FIELDS.items():
+    value = entry.get(field)
+    if value is None:
+      if required:
+        raise ReposFileError("{}: missing '{}'".format(context, field))
+      continue
+    # `bool` is a subclass of `int`.
+    if not isinstance(value, field_type) or isinstance(value, bool):
+      raise ReposFileError("{}: invalid '{}': {!r}".format(
+          context, field, value))
+  if entry.get("fetch_depth") is not None and entry["fetch_depth"] < 1:
+    raise ReposFileError("{}: 'fetch_depth' must be positive".format(context))
+  for dest_branch in entry.get("dest_branches") or []:
+    if not isinstance(dest_branch, _STRING):
+      raise ReposFileError("{}: invalid destination branch: {!r}".format(
+          context, dest_branch))
+  return IndividualRepo(entry["location"],
+                        entry["branch"],
+                        name = entry.get("name"),
+                        destination = entry.get("destination"),
+                        fetch_depth = entry.get("fetch_depth"),
+                        fetch_filter = entry.get("fetch_filter"),
+                        shallow_since = entry.get("shallow_since"))
+
+
+def _check_keys(obj, allowed_keys, context):
+  unknown_keys = sorted(set(obj.keys()) - set(allowed_keys))
+  if unknown_keys:
+    raise ReposFileError("{}: unknown keys: {}".format(
+        context, ", ".join(unknown_keys)))
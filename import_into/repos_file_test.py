@@ -0,0 +1,79 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Unit tests for the `repos_file` module."""
+import os
+import unittest
+from monorepo_tools.import_into import load_individual_repos, ReposFileError
+from monorepo_tools.import_into.repos_file import parse_individual_repos
+
+
+class ReposFileTest(unittest.TestCase):
+
+  def test_example_is_valid(self):
+    individual_repos = load_individual_repos(
+        os.path.join(os.path.dirname(__file__), "individual_repos.json"),
+        "stitched")
+    self.assertEqual([repo.name for repo in individual_repos],
+                     ["redux", "recompose"])
+    self.assertEqual(individual_repos[0].destination, "packages/redux/core")
+
+  def test_options_and_defaults(self):
+    individual_repos = parse_individual_repos(
+        repos_file({
+            "location": "/repos/repo1.git",
+            "branch": "master",
+            "fetch_depth": 10,
+            "fetch_filter": "blob:none",
+        }), "master")
+    self.assertEqual(len(individual_repos), 1)
+    self.assertEqual(individual_repos[0].name, "repo1")
+    self.assertEqual(individual_repos[0].destination, "repo1")
+    self.assertEqual(individual_repos[0].fetch_depth, 10)
+    self.assertEqual(individual_repos[0].fetch_filter, "blob:none")
+    self.assertIsNone(individual_repos[0].shallow_since)
+
+  def test_dest_branches(self):
+    data = repos_file(
+        repo_entry("/repos/repo1"),
+        repo_entry("/repos/repo2", dest_branches = ["release"]))
+    self.assertEqual(
+        [repo.name for repo in parse_individual_repos(data, "master")],
+        ["repo1"])
+    self.assertEqual(
+        [repo.name for repo in parse_individual_repos(data, "release")],
+        ["repo1", "repo2"])
+
+  def test_invalid_repos_files(self):
+    for (data, message) in [
+        ([], "expected an object"),
+        ({"individual_repos": []}, "unsupported version None"),
+        ({"version": 1}, "'individual_repos' must be a list"),
+        (dict(repos_file(), foo = 1), "unknown keys: foo"),
+        (repos_file({"location": "/repos/repo1"}),
+         "individual_repos[0]: missing 'branch'"),
+        (repos_file(repo_entry("/repos/repo1", fetch_depth = "1")),
+         "individual_repos[0]: invalid 'fetch_depth'"),
+        (repos_file(repo_entry("/repos/repo1", fetch_depth = 0)),
+         "'fetch_depth' must be positive"),
+        (repos_file(repo_entry("/repos/repo1", brnach = "master")),
+         "individual_repos[0]: unknown keys: brnach"),
+        (repos_file(repo_entry("/a/repo1"), repo_entry("/b/repo1")),
+         "duplicate individual repo 'repo1'"),
+    ]:
+      with self.assertRaises(ReposFileError) as context:
+        parse_individual_repos(data, "master")
+      self.assertIn(message, str(context.exception))
+
+
+def repos_file(*entries):
+  return {"version": 1, "individual_repos": list(entries)}
+
+
+def repo_entry(location, **options):
+  return dict({"location": location, "branch": "master"}, **options)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -7,18 +7,66 @@ the files coming from the individual directories.
 
 This algorithm discards history, but is useful for testing purposes.
 """
+import binascii
+import collections
 import os
 import logging
 import tempfile
 import shutil
 import subprocess
+import time
 from git import Repo, Actor
-from monorepo_tools.import_into import IndividualRepo
+from git.exc import GitCommandError, InvalidGitRepositoryError
+from monorepo_tools.common.concurrency import map_in_pool
+from monorepo_tools.common.pathutils import (onerror, copytree,
+                                             hardlink_or_copy, reflink_or_copy,
+                                             rename_or_copy)
+from monorepo_tools.import_into import IndividualRepo, SyncError
+from monorepo_tools.import_into.import_into import _is_nested
+from monorepo_tools.import_into.metrics import (Metrics, count_git_processes,
+                                                GIT_PROCESSES)
 
 DEFAULT_AUTHOR = Actor("monorepo-tools", "monorepo-tools@chauvin.io")
 DEFAULT_COMMITTER = DEFAULT_AUTHOR
 DEFAULT_LOGGER_NAME = "monorepo"
 TEMP_ROOT_DIR = "~/.monorepo-tools"
+COMMIT_MESSAGE = "Monorepo commit"
+#: Prefix of the lines of the commit message, with `BACKEND_FAST_IMPORT`,
+#: that record the tip of each individual repo.
+TIP_PREFIX = "Individual-Repo: "
+
+#: Backend that clones the individual repos, copies their files into the
+#: working tree of the monorepo, then adds and commits them.
+BACKEND_COPY = "copy"
+#: Backend that streams the files from the object database of bare clones
+#: of the individual repos into `git fast-import`, without writing them to
+#: disk.
+BACKEND_FAST_IMPORT = "fast_import"
+BACKENDS = [BACKEND_COPY, BACKEND_FAST_IMPORT]
+
+#: Copies the files from the clones to the monorepo.
+COPY_STRATEGY_COPY = "copy"
+#: Hard links the files from the clones to the monorepo.
+COPY_STRATEGY_HARDLINK = "hardlink"
+#: Shares the data blocks of the files between the clones and the monorepo
+#: on copy-on-write file systems, or copies them in the kernel.
+COPY_STRATEGY_REFLINK = "reflink"
+#: Moves the clones, without their `.git` folder, into the monorepo.  The
+#: clones are consumed.
+COPY_STRATEGY_MOVE = "move"
+COPY_STRATEGIES = [
+    COPY_STRATEGY_COPY, COPY_STRATEGY_HARDLINK, COPY_STRATEGY_REFLINK,
+    COPY_STRATEGY_MOVE
+]
+_COPY_FUNCTIONS = {
+    COPY_STRATEGY_COPY: shutil.copy2,
+    COPY_STRATEGY_HARDLINK: hardlink_or_copy,
+    COPY_STRATEGY_REFLINK: reflink_or_copy,
+    COPY_STRATEGY_MOVE: rename_or_copy,
+}
+
+_GITLINK_MODE = b"160000"
+_CHUNK_SIZE = 64 * 1024
 
 
 def single_commit(monorepo,
@@ -28,7 +76,12 @@ def single_commit(monorepo,
                   silent = False,
                   author = DEFAULT_AUTHOR,
                   committer = DEFAULT_COMMITTER,
-                  logger_name = DEFAULT_LOGGER_NAME):
+                  logger_name = DEFAULT_LOGGER_NAME,
+                  backend = BACKEND_COPY,
+                  checkout = True,
+                  jobs = 1,
+                  copy_strategy = COPY_STRATEGY_COPY,
+                  incremental = False):
   """Imports individual repos into a monorepo using a "single commit" strategy.
   The history of the individual repos is discarded.
 
@@ -42,7 +95,44 @@ def single_commit(monorepo,
     author: The author to use when the import algorithm creates commits.
     committer: The committer to use when the import algorithm creates commits.
     logger_name: The `logging` logger name to use for all progress reports.
+    backend: The backend to use to create the commit, one of `BACKENDS`.
+      With `BACKEND_FAST_IMPORT`, the individual repos are cloned without
+      a working tree, and their files are streamed into a single
+      `git fast-import` process: they are never written to disk, except
+      by the final checkout.
+    checkout: Whether to check out the destination branch at the end of the
+      import.  Only `BACKEND_FAST_IMPORT` can skip the checkout.
+    jobs: The maximum number of individual repos to clone, or copy,
+      concurrently.  The commit is always created in a single step.
+    copy_strategy: How `BACKEND_COPY` puts the files of the clones in the
+      monorepo, one of `COPY_STRATEGIES`.  All the strategies fall back to
+      a plain copy when they are not supported, e.g. when the working
+      directory and the monorepo are on different file systems.
+    incremental: Whether to keep the shallow clones in `workdir` from one
+      import to the next, and to create the commit on top of the previous
+      one in `dest_branch_name`.  Only the new tips are fetched, and only
+      the files that changed since the previous commit are streamed: when
+      no individual repo changed, no commit is created.  Requires
+      `BACKEND_FAST_IMPORT` and a `workdir`.
+  Returns:
+    The metrics of the import, of type `metrics.Metrics`.
+  Raises:
+    SyncError: Some individual repos could not be cloned or copied.  No
+      commit is created.
   """
+  if backend not in BACKENDS:
+    raise ValueError("unknown backend '{}'; expected one of {}".format(
+        backend, BACKENDS))
+  if copy_strategy not in COPY_STRATEGIES:
+    raise ValueError("unknown copy strategy '{}'; expected one of {}".format(
+        copy_strategy, COPY_STRATEGIES))
+  if not checkout and backend != BACKEND_FAST_IMPORT:
+    raise ValueError("only the '{}' backend can skip the checkout".format(
+        BACKEND_FAST_IMPORT))
+  if incremental and (backend != BACKEND_FAST_IMPORT or not workdir):
+    raise ValueError(
+        "incremental imports need the '{}' backend and a workdir".format(
+            BACKEND_FAST_IMPORT))
   syncer = _SingleCommit(monorepo, individual_repos, author, committer,
                          logger_name)
   if silent:
@@ -55,14 +145,34 @@ def single_commit(monorepo,
       os.mkdir(temp_root_dir)
     temp_workdir_holder = tempfile.TemporaryDirectory(dir = temp_root_dir)
     workdir = temp_workdir_holder.name
-  try:
-    syncer.clone_single_branches(workdir)
-    syncer.copy(workdir)
-  finally:
-    if temp_workdir_holder:
-      temp_workdir_holder.cleanup()
-  syncer.create_dest_branch(dest_branch_name)
+  metrics = syncer.metrics
+  with count_git_processes(monorepo, metrics):
+    try:
+      with metrics.phase("clone"):
+        syncer.clone_single_branches(
+            workdir,
+            bare = backend == BACKEND_FAST_IMPORT,
+            jobs = jobs,
+            update = incremental)
+      if backend == BACKEND_FAST_IMPORT:
+        with metrics.phase("commit"):
+          committed = syncer.create_dest_branch_from_objects(
+              workdir, dest_branch_name, incremental)
+      else:
+        with metrics.phase("copy"):
+          syncer.copy(workdir, jobs, copy_strategy)
+    finally:
+      if temp_workdir_holder:
+        temp_workdir_holder.cleanup()
+    if backend == BACKEND_FAST_IMPORT:
+      if checkout:
+        with metrics.phase("checkout"):
+          syncer.check_out(dest_branch_name, committed)
+    else:
+      with metrics.phase("commit"):
+        syncer.create_dest_branch(dest_branch_name)
   syncer.logger.info("Done")
+  return metrics
 
 
 class _SingleCommit:
@@ -74,6 +184,7 @@ class _SingleCommit:
     self.individual_repos = individual_repos
     self.author = author
     self.committer = committer
+    self.metrics = Metrics()
 
     self._init_environ()
     self._init_logger()
@@ -96,31 +207,337 @@ class _SingleCommit:
     ch.setFormatter(logging.Formatter("+%(relativeCreated)dms - %(message)s"))
     self.logger.addHandler(ch)
 
-  def clone_single_branches(self, workdir):
+  def clone_single_branches(self, workdir, bare = False, jobs = 1,
+                            update = False):
+    """Clones the individual repos into `workdir`.  With `update`, the
+    existing clones are updated to the new tips instead."""
     self.logger.info("Clone single branches...")
-    for individual_repo in self.individual_repos:
+
+    def clone(individual_repo):
       self.logger.info("For {}: {}".format(individual_repo.name,
                                            individual_repo.branch))
-      Repo.clone_from(
-          individual_repo.location,
-          os.path.join(workdir, individual_repo.name),
-          single_branch = True,
-          branch = individual_repo.branch,
-          depth = 1)
-
-  def copy(self, workdir):
+      clone_dir = os.path.join(workdir, individual_repo.name)
+      with self.metrics.phase("clone", individual_repo.name):
+        if update and _is_clone_of(clone_dir, individual_repo):
+          existing_clone = Repo(clone_dir)
+          try:
+            existing_clone.git.fetch("--depth", "1", "origin",
+                                     individual_repo.branch)
+            existing_clone.git.update_ref("HEAD", "FETCH_HEAD")
+          finally:
+            existing_clone.close()
+          self.metrics.increment(GIT_PROCESSES, 2)
+          return
+        if os.path.exists(clone_dir):
+          shutil.rmtree(clone_dir, onerror = onerror)
+        Repo.clone_from(
+            individual_repo.location,
+            clone_dir,
+            single_branch = True,
+            branch = individual_repo.branch,
+            depth = 1,
+            bare = bare)
+        # The clones do not go through `self.monorepo.git`.
+        self.metrics.increment(GIT_PROCESSES)
+
+    self._for_each_individual_repo(clone, jobs)
+
+  def copy(self, workdir, jobs = 1, strategy = COPY_STRATEGY_COPY):
     self.logger.info("Copying files in individual repos...")
-    for individual_repo in self.individual_repos:
+
+    def copy_files(individual_repo):
       self.logger.info(individual_repo.name)
-      shutil.copytree(
-          os.path.join(workdir, individual_repo.name),
-          os.path.join(self.monorepo.working_dir, individual_repo.destination),
-          symlinks = True,
-          ignore = shutil.ignore_patterns(".git"))
+      with self.metrics.phase("copy", individual_repo.name):
+        clone_dir = os.path.join(workdir, individual_repo.name)
+        dest_dir = os.path.join(self.monorepo.working_dir,
+                                individual_repo.destination)
+        if strategy == COPY_STRATEGY_MOVE and _move_tree(clone_dir, dest_dir):
+          return
+        copytree(
+            clone_dir,
+            dest_dir,
+            _COPY_FUNCTIONS[strategy],
+            ignore = shutil.ignore_patterns(".git"))
+
+    self._for_each_individual_repo(copy_files, jobs)
+
+  def _for_each_individual_repo(self, fun, jobs):
+    """Calls a function on each individual repo, with at most `jobs` calls
+    running concurrently, and raises `SyncError` if any call failed."""
+    results = map_in_pool(fun, self.individual_repos, jobs)
+    errors = {}
+    for (individual_repo, (_, error)) in zip(self.individual_repos, results):
+      if error:
+        self.logger.error("{}: FAILED: {}".format(individual_repo.name, error))
+        errors[individual_repo.name] = error
+    if errors:
+      raise SyncError(errors, self.metrics)
 
   def create_dest_branch(self, dest_branch_name):
     self.logger.info("Create destination branch...")
     self.monorepo.git.checkout("-b", dest_branch_name)
     self.monorepo.git.add("-A")
-    self.monorepo.git.commit("-m", "Monorepo commit")
+    self.monorepo.git.commit("-m", COMMIT_MESSAGE)
+    self.logger.info("Monorepo commit successfully made")
+
+  def create_dest_branch_from_objects(self,
+                                      workdir,
+                                      dest_branch_name,
+                                      incremental = False):
+    """Creates the destination branch with `git fast-import`, from the bare
+    clones in `workdir`.  As with `create_dest_branch`, the commit is on top
+    of `HEAD`, if any.
+
+    With `incremental`, the commit is instead on top of the previous one in
+    the destination branch, and only the files that changed since then are
+    streamed.
+
+    Returns:
+      Whether a commit was created.
+    """
+    self.logger.info("Stream files into destination branch...")
+    dest_branch = None
+    previous_tips = {}
+    if dest_branch_name in self.monorepo.heads:
+      if not incremental:
+        raise ValueError("branch '{}' already exists".format(dest_branch_name))
+      dest_branch = self.monorepo.heads[dest_branch_name]
+      previous_tips = _parse_tips(dest_branch.commit.message)
+    clones = collections.OrderedDict()
+    tips = collections.OrderedDict()
+    try:
+      for individual_repo in self.individual_repos:
+        clone = Repo(os.path.join(workdir, individual_repo.name))
+        clones[individual_repo.name] = clone
+        tips[individual_repo.name] = (clone.head.commit.hexsha,
+                                      individual_repo.destination)
+      if dest_branch and tips == previous_tips:
+        self.logger.info("SKIP: up-to-date")
+        return False
+      if dest_branch:
+        parent = dest_branch.commit
+      elif self.monorepo.head.is_valid():
+        parent = self.monorepo.head.commit
+      else:
+        parent = None
+      self._fast_import(dest_branch_name, parent, tips, previous_tips, clones)
+    finally:
+      for clone in clones.values():
+        clone.close()
     self.logger.info("Monorepo commit successfully made")
+    return True
+
+  def _fast_import(self, dest_branch_name, parent, tips, previous_tips,
+                   clones):
+    command = ["git", "fast-import", "--quiet"]
+    process = subprocess.Popen(
+        command, cwd = self.monorepo.git_dir, stdin = subprocess.PIPE)
+    self.metrics.increment(GIT_PROCESSES)
+    try:
+      write = process.stdin.write
+      write(self._commit_header(dest_branch_name, parent, tips))
+      # Deletions go first, so that they do not remove the new files of
+      # another individual repo.
+      deleted = [
+          destination
+          for (repo_name, (_, destination)) in previous_tips.items()
+          if tips.get(repo_name, (None, None))[1] != destination
+      ]
+      full_streams = set()
+      for (repo_name, (hexsha, destination)) in tips.items():
+        previous = previous_tips.get(repo_name)
+        if previous == (hexsha, destination) or (
+            previous and previous[1] == destination and
+            _has_object(clones[repo_name], previous[0])):
+          continue
+        # The previous files are not known, e.g., the upstream branch was
+        # force-pushed and the clone re-created: the files deleted upstream
+        # must not survive.
+        full_streams.add(repo_name)
+        if previous_tips:
+          deleted.append(destination)
+      # The individual repos nested in a deleted destination are streamed
+      # again.
+      for (repo_name, (_, destination)) in tips.items():
+        if any(
+            destination == other or _is_nested(destination, other)
+            for other in deleted):
+          full_streams.add(repo_name)
+      for destination in deleted:
+        write(b"D " + _quote_path(_encode_path(destination)) + b"\n")
+      for (repo_name, (hexsha, destination)) in tips.items():
+        previous = previous_tips.get(repo_name)
+        up_to_date = previous == (hexsha, destination)
+        if up_to_date and repo_name not in full_streams:
+          self.logger.info("{}: SKIP: up-to-date".format(repo_name))
+          continue
+        self.logger.info(repo_name)
+        clone = clones[repo_name]
+        with self.metrics.phase("stream", repo_name):
+          if repo_name in full_streams:
+            _stream_files(clone, destination, write)
+          else:
+            _stream_changes(clone, previous[0], destination, write)
+      write(b"\n")
+    finally:
+      process.stdin.close()
+    status = process.wait()
+    if status != 0:
+      raise GitCommandError(command, status)
+
+  def check_out(self, dest_branch_name, committed = True):
+    """Checks out the destination branch after
+    `create_dest_branch_from_objects`."""
+    head = self.monorepo.head
+    if not head.is_detached and head.reference.name == dest_branch_name:
+      if committed:
+        # The branch moved under the working tree.
+        head.reset(index = True, working_tree = True)
+      return
+    self.monorepo.git.checkout(dest_branch_name)
+
+  def _commit_header(self, dest_branch_name, parent, tips):
+    now = int(time.time())
+    message = "\n".join([COMMIT_MESSAGE, ""] + [
+        "{}{} {} {}".format(TIP_PREFIX, repo_name, hexsha, destination)
+        for (repo_name, (hexsha, destination)) in tips.items()
+    ]) + "\n"
+    message = message.encode("utf-8")
+    lines = [
+        "commit refs/heads/{}".format(dest_branch_name),
+        "author {} <{}> {} +0000".format(self.author.name, self.author.email,
+                                         now),
+        "committer {} <{}> {} +0000".format(self.committer.name,
+                                            self.committer.email, now),
+        "data {}".format(len(message)),
+    ]
+    header = ("\n".join(lines) + "\n").encode("utf-8") + message
+    if parent:
+      header += "from {}\n".format(parent.hexsha).encode("utf-8")
+    return header
+
+
+def _is_clone_of(clone_dir, individual_repo):
+  if not os.path.isdir(clone_dir):
+    return False
+  try:
+    clone = Repo(clone_dir)
+  except InvalidGitRepositoryError:
+    return False
+  try:
+    return clone.remotes.origin.url == individual_repo.location
+  finally:
+    clone.close()
+
+
+def _has_object(repo, hexsha):
+  try:
+    repo.git.cat_file("-e", hexsha)
+    return True
+  except GitCommandError:
+    return False
+
+
+def _parse_tips(message):
+  """Parses the tips recorded by `_SingleCommit._commit_header`.
+
+  Returns:
+    An ordered dictionary of individual repo names to `(hexsha,
+    destination)` tuples.
+  """
+  tips = collections.OrderedDict()
+  for line in message.splitlines():
+    if line.startswith(TIP_PREFIX):
+      (repo_name, hexsha, destination) = line[len(TIP_PREFIX):].split(" ", 2)
+      tips[repo_name] = (hexsha, destination)
+  return tips
+
+
+def _move_tree(clone_dir, dest_dir):
+  """Moves a clone, without its `.git` folder, with a single rename.
+
+  Returns:
+    Whether the clone could be moved.
+  """
+  if os.path.lexists(dest_dir):
+    return False
+  parent_dir = os.path.dirname(dest_dir)
+  try:
+    os.makedirs(parent_dir)
+  except OSError:
+    # Created concurrently, for the destination of another individual repo
+    if not os.path.isdir(parent_dir):
+      raise
+  try:
+    os.rename(clone_dir, dest_dir)
+  except OSError:
+    # The clone is left as is, for the copy.
+    return False
+  shutil.rmtree(os.path.join(dest_dir, ".git"), onerror = onerror)
+  return True
+
+
+def _stream_files(clone, destination, write):
+  """Writes `git fast-import` file commands for all the files of a clone,
+  prefixed with `destination`.  The content of the files is streamed from
+  the object database of the clone."""
+  prefix = _encode_path(destination) + b"/"
+  listing = clone.git.ls_tree(
+      "-r", "-z", "--full-tree", "HEAD", stdout_as_string = False)
+  for record in listing.split(b"\0"):
+    if not record:
+      continue
+    (info, path) = record.split(b"\t", 1)
+    (mode, _, hexsha) = info.split(b" ")
+    _write_file(clone, mode, hexsha, prefix + path, write)
+
+
+def _stream_changes(clone, previous_hexsha, destination, write):
+  """Writes `git fast-import` file commands for the files of a clone that
+  changed since a previous commit, prefixed with `destination`."""
+  prefix = _encode_path(destination) + b"/"
+  diff = clone.git.diff_tree(
+      "-r",
+      "-z",
+      "--no-renames",
+      previous_hexsha,
+      "HEAD",
+      stdout_as_string = False).split(b"\0")
+  # Each change is a `:<old mode> <new mode> <old sha> <new sha> <status>`
+  # record followed by a path record.
+  for i in range(0, len(diff) - 1, 2):
+    (_, mode, _, hexsha, status) = diff[i].split(b" ")
+    path = prefix + diff[i + 1]
+    if status == b"D":
+      write(b"D " + _quote_path(path) + b"\n")
+    else:
+      _write_file(clone, mode, hexsha, path, write)
+
+
+def _write_file(clone, mode, hexsha, path, write):
+  path = _quote_path(path)
+  if mode == _GITLINK_MODE:
+    # Submodules are only recorded by the commit they point to.
+    write(b"M " + mode + b" " + hexsha + b" " + path + b"\n")
+    return
+  stream = clone.odb.stream(binascii.unhexlify(hexsha))
+  write(b"M " + mode + b" inline " + path + b"\n")
+  write("data {}\n".format(stream.size).encode("utf-8"))
+  remaining = stream.size
+  while remaining > 0:
+    chunk = stream.read(min(remaining, _CHUNK_SIZE))
+    write(chunk)
+    remaining -= len(chunk)
+  write(b"\n")
+
+
+def _encode_path(destination):
+  return destination.strip("/").encode("utf-8")
+
+
+def _quote_path(path):
+  """Quotes a path for `git fast-import`, if needed."""
+  if b"\n" not in path and not path.startswith(b'"'):
+    return path
+  escaped = path.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+  return b'"' + escaped.replace(b"\n", b"\\n") + b'"'
@@ -0,0 +1,189 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Unit tests for the `single_commit` module."""
+import os
+import shutil
+import unittest
+from git import Repo
+from monorepo_tools.common.pathutils import onerror
+from monorepo_tools.import_into import IndividualRepo, SyncError
+from single_commit import (single_commit, BACKENDS, BACKEND_FAST_IMPORT,
+                           COPY_STRATEGIES)
+from testutils import REPOS_ROOT, init_synthetic_repo, add_synthetic_commit
+
+
+class SingleCommitTest(unittest.TestCase):
+
+  def setUp(self):
+    if os.path.exists(REPOS_ROOT):
+      shutil.rmtree(REPOS_ROOT, onerror = onerror)
+    os.mkdir(REPOS_ROOT)
+
+  def test_backends_create_the_same_tree(self):
+    individual_repos = init_individual_repos()
+    trees = set()
+    for backend in BACKENDS:
+      monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo_" + backend))
+      single_commit(
+          monorepo,
+          individual_repos,
+          "develop",
+          workdir = os.path.join(REPOS_ROOT, "workdir_" + backend),
+          silent = True,
+          backend = backend,
+          jobs = 2)
+      self.assertEqual(monorepo.head.reference.path, "refs/heads/develop")
+      self.assertFalse(monorepo.is_dirty(untracked_files = True))
+      trees.add(monorepo.rev_parse("develop^{tree}").hexsha)
+    self.assertEqual(len(trees), 1)
+
+  def test_copy_strategies_create_the_same_tree(self):
+    individual_repos = init_individual_repos()
+    trees = set()
+    for copy_strategy in COPY_STRATEGIES:
+      monorepo = Repo.init(
+          os.path.join(REPOS_ROOT, "monorepo_" + copy_strategy))
+      single_commit(
+          monorepo,
+          individual_repos,
+          "develop",
+          workdir = os.path.join(REPOS_ROOT, "workdir_" + copy_strategy),
+          silent = True,
+          copy_strategy = copy_strategy)
+      self.assertFalse(monorepo.is_dirty(untracked_files = True))
+      trees.add(monorepo.rev_parse("develop^{tree}").hexsha)
+    self.assertEqual(len(trees), 1)
+
+  def test_fast_import_backend_can_skip_the_checkout(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    single_commit(
+        monorepo,
+        init_individual_repos(),
+        "develop",
+        workdir = os.path.join(REPOS_ROOT, "workdir"),
+        silent = True,
+        backend = BACKEND_FAST_IMPORT,
+        checkout = False)
+    self.assertEqual(os.listdir(monorepo.working_dir), [".git"])
+    self.assertEqual(
+        monorepo.rev_parse("develop:packages/repo1/d0/f0.txt").data_stream
+        .read(), b"0\n")
+
+  def test_clone_failures_are_reported(self):
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    individual_repos = init_individual_repos() + [
+        IndividualRepo(
+            os.path.join(REPOS_ROOT, "missing"), "master", name = "missing")
+    ]
+    with self.assertRaises(SyncError) as context:
+      single_commit(
+          monorepo,
+          individual_repos,
+          "develop",
+          workdir = os.path.join(REPOS_ROOT, "workdir"),
+          silent = True,
+          jobs = 3)
+    self.assertEqual(list(context.exception.errors.keys()), ["missing"])
+    self.assertNotIn("develop", monorepo.heads)
+
+  def test_incremental_imports_only_stream_what_changed(self):
+    individual_repos = init_individual_repos()
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    options = {
+        "workdir": os.path.join(REPOS_ROOT, "workdir"),
+        "silent": True,
+        "backend": BACKEND_FAST_IMPORT,
+        "incremental": True,
+    }
+    single_commit(monorepo, individual_repos, "develop", **options)
+    first_commit = monorepo.rev_parse("develop")
+
+    metrics = single_commit(monorepo, individual_repos, "develop", **options)
+    self.assertEqual(monorepo.rev_parse("develop"), first_commit)
+    self.assertNotIn("stream", metrics.repos["repo0"]["phases"])
+
+    add_synthetic_commit(Repo(individual_repos[0].location), "master")
+    metrics = single_commit(monorepo, individual_repos, "develop", **options)
+    self.assertEqual(monorepo.rev_parse("develop").parents, (first_commit,))
+    self.assertIn("stream", metrics.repos["repo0"]["phases"])
+    self.assertNotIn("stream", metrics.repos["repo1"]["phases"])
+    self.assertFalse(monorepo.is_dirty(untracked_files = True))
+
+    # Same tree as a snapshot from scratch
+    fresh_monorepo = Repo.init(os.path.join(REPOS_ROOT, "fresh_monorepo"))
+    single_commit(
+        fresh_monorepo,
+        individual_repos,
+        "develop",
+        workdir = os.path.join(REPOS_ROOT, "fresh_workdir"),
+        silent = True,
+        backend = BACKEND_FAST_IMPORT)
+    self.assertEqual(
+        monorepo.rev_parse("develop^{tree}"),
+        fresh_monorepo.rev_parse("develop^{tree}"))
+
+    # Removing an individual repo removes its files.
+    single_commit(monorepo, individual_repos[:1], "develop", **options)
+    self.assertEqual(
+        [entry.name for entry in monorepo.rev_parse("develop:packages")],
+        ["repo0"])
+
+  def test_incremental_imports_restream_force_pushed_repos(self):
+    individual_repos = init_individual_repos()
+    # repo1 is nested in repo0.
+    individual_repos[1] = IndividualRepo(
+        individual_repos[1].location,
+        "master",
+        name = "repo1",
+        destination = "packages/repo0/vendor/repo1")
+    monorepo = Repo.init(os.path.join(REPOS_ROOT, "monorepo"))
+    workdir = os.path.join(REPOS_ROOT, "workdir")
+    options = {
+        "workdir": workdir,
+        "silent": True,
+        "backend": BACKEND_FAST_IMPORT,
+        "incremental": True,
+    }
+    single_commit(monorepo, individual_repos, "develop", **options)
+
+    # The upstream branch of repo0 is force-pushed with fewer files, and
+    # its clone is re-created, so that the previous tip is not in it.
+    shutil.rmtree(individual_repos[0].location, onerror = onerror)
+    init_synthetic_repo(
+        individual_repos[0].location, "master", files = 4, depth = 1, seed = 1)
+    shutil.rmtree(os.path.join(workdir, "repo0"), onerror = onerror)
+    metrics = single_commit(monorepo, individual_repos, "develop", **options)
+    self.assertIn("stream", metrics.repos["repo1"]["phases"])
+
+    # Same tree as a snapshot from scratch
+    fresh_monorepo = Repo.init(os.path.join(REPOS_ROOT, "fresh_monorepo"))
+    single_commit(
+        fresh_monorepo,
+        individual_repos,
+        "develop",
+        workdir = os.path.join(REPOS_ROOT, "fresh_workdir"),
+        silent = True,
+        backend = BACKEND_FAST_IMPORT)
+    self.assertEqual(
+        monorepo.rev_parse("develop^{tree}"),
+        fresh_monorepo.rev_parse("develop^{tree}"))
+
+
+def init_individual_repos():
+  individual_repos = []
+  for name in ["repo0", "repo1"]:
+    repo = init_synthetic_repo(
+        os.path.join(REPOS_ROOT, name), "master", files = 8, depth = 1)
+    individual_repos.append(
+        IndividualRepo(
+            repo.git_dir,
+            "master",
+            name = name,
+            destination = "packages/{}".format(name)))
+  return individual_repos
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -6,11 +6,15 @@
 import attr
 import os
 from git import Repo, NULL_TREE
+import random
 import re
+import subprocess
 import sys
+import tempfile
 
 #: Where to put all the test repos
-REPOS_ROOT = os.path.join(os.environ["TEST_TMPDIR"], "REPOS")
+REPOS_ROOT = os.path.join(
+    os.environ.get("TEST_TMPDIR", tempfile.gettempdir()), "REPOS")
 
 
 @attr.s(frozen = True)
@@ -82,6 +86,133 @@ def repo_file(repo, filename, content):
     f.write(content)
 
 
+def init_synthetic_repo(path,
+                        branch,
+                        files = 10,
+                        depth = 1,
+                        commits = 1,
+                        side_branches = 0,
+                        seed = 0):
+  """Creates a bare repo with synthetic content, using `git fast-import`
+  so that big repos are quick to generate.
+
+  Args:
+    path: Where to create the repo.
+    branch: The branch to put the commits in.
+    files: The number of files in the first commit.
+    depth: The number of directories between the root and each file.
+    commits: The number of commits on `branch`.  Each commit after the
+      first one modifies a few files and adds one.
+    side_branches: The number of commits of `branch` that are the merge
+      of a side branch, which adds one file.  The first commit is never a
+      merge, so there are fewer side branches than commits.
+    seed: The seed of the random generator that chooses the files to
+      modify.
+  Returns:
+    The repo, of type `git.Repo`.
+  Raises:
+    ValueError: There are too many side branches for the commits.
+  """
+  if side_branches >= commits:
+    raise ValueError("{} side branches need more than {} commits".format(
+        side_branches, commits))
+  repo = Repo.init(path, bare = True)
+  rng = random.Random(seed)
+  fanout = max(2, int(round(files**(1.0 / (depth + 1)))))
+
+  def file_path(i):
+    parts = [
+        "d{}".format((i // fanout**(depth - level)) % fanout)
+        for level in range(depth)
+    ]
+    return "/".join(parts + ["f{}.txt".format(i)])
+
+  def file_command(i, content):
+    data = "{}\n".format(content).encode("utf-8")
+    return b"M 100644 inline " + file_path(i).encode("utf-8") + \
+        "\ndata {}\n".format(len(data)).encode("utf-8") + data + b"\n"
+
+  def commit_command(ref, mark, message, file_commands, parents):
+    header = [
+        "commit {}".format(ref),
+        "mark :{}".format(mark),
+        "committer Synthetic <synthetic@domain.test> {} +0000".format(
+            1500000000 + mark),
+        "data {}".format(len(message)),
+        message,
+    ]
+    if parents:
+      header.append("from :{}".format(parents[0]))
+    header += ["merge :{}".format(parent) for parent in parents[1:]]
+    return ("\n".join(header) + "\n").encode("utf-8") + b"".join(
+        file_commands) + b"\n"
+
+  merge_every = commits // (side_branches + 1) if side_branches else 0
+  stream = [
+      commit_command("refs/heads/" + branch, 1, "Commit 1",
+                     [file_command(i, i) for i in range(files)], [])
+  ]
+  next_file = files
+  mark = 1
+  head = 1
+  for commit in range(2, commits + 1):
+    file_commands = [
+        file_command(rng.randrange(next_file), "{}-{}".format(commit, i))
+        for i in range(max(1, files // 100))
+    ] + [file_command(next_file, next_file)]
+    next_file += 1
+    parents = [head]
+    if side_branches and commit % merge_every == 0:
+      side_branches -= 1
+      mark += 1
+      stream.append(
+          commit_command("refs/heads/side", mark,
+                         "Side commit {}".format(commit),
+                         [file_command(next_file, next_file)], [head]))
+      next_file += 1
+      parents.append(mark)
+    mark += 1
+    stream.append(
+        commit_command("refs/heads/" + branch, mark,
+                       "Commit {}".format(commit),
+                       file_commands, parents))
+    head = mark
+  _fast_import(repo, b"".join(stream))
+  repo.git.update_ref("-d", "refs/heads/side")
+  repo.git.symbolic_ref("HEAD", "refs/heads/" + branch)
+  return repo
+
+
+def add_synthetic_commit(repo, branch, files = 1):
+  """Adds a commit to a synthetic repo (see `init_synthetic_repo`).  The
+  commit adds new files in a new directory.
+  """
+  count = len(list(repo.iter_commits(branch)))
+  directory = "new{}".format(count)
+  stream = [
+      "commit refs/heads/{}".format(branch),
+      "committer Synthetic <synthetic@domain.test> {} +0000".format(
+          1600000000 + count),
+      "data 10",
+      "New commit",
+      "from refs/heads/{}^0".format(branch),
+  ] + [
+      "M 100644 inline {}/f{}.txt\ndata 2\n{}\n".format(directory, i, i % 10)
+      for i in range(files)
+  ]
+  _fast_import(repo, ("\n".join(stream) + "\n").encode("utf-8"))
+
+
+def _fast_import(repo, stream):
+  process = subprocess.Popen(["git", "fast-import", "--quiet"],
+                             cwd = repo.git_dir,
+                             stdin = subprocess.PIPE)
+  process.communicate(stream)
+  if process.returncode != 0:
+    raise Exception("git fast-import failed with code {}".format(
+        process.returncode))
+
+
 def debug_repos():
   """Shows debug infos about all the repos."""
   for repo_name in os.listdir(REPOS_ROOT):
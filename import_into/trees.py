@@ -0,0 +1,130 @@
+# Copyright (c) Hadrien Chauvin
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Helpers to build Git tree objects directly in the object database,
+without going through an index or a working tree.
+
+Trees are identified by their binary SHA1 (`binsha`), and tree entries
+are `(binsha, mode, name)` tuples, as in `git.objects.fun`.
+"""
+from io import BytesIO
+from gitdb.base import IStream
+from git.objects.fun import tree_to_stream, tree_entries_from_data
+
+#: Mode of a tree entry that points to another tree.
+TREE_MODE = 0o40000
+
+
+def write_tree(repo, entries):
+  """Writes a tree object.
+
+  Args:
+    repo: The repo, of type `git.Repo`, to write the tree into.
+    entries: Sequence of `(binsha, mode, name)` tuples.  They do not need
+      to be sorted.
+  Returns:
+    The binary SHA1 of the tree.
+  """
+  stream = BytesIO()
+  tree_to_stream(sorted(entries, key = _tree_entry_sort_key), stream.write)
+  data = stream.getvalue()
+  return repo.odb.store(IStream("tree", len(data), BytesIO(data))).binsha
+
+
+def read_tree(repo, binsha):
+  """Reads the entries of a tree object.
+
+  Returns:
+    A list of `(binsha, mode, name)` tuples.
+  """
+  return tree_entries_from_data(repo.odb.stream(binsha).read())
+
+
+def nest_tree(repo, binsha, path):
+  """Nests a tree under a relative path.  For instance, nesting tree `T`
+  under `foo/bar` gives a root tree with one entry, `foo`, that points
+  to a tree with one entry, `bar`, that points to `T`.
+
+  Only one tree object is written for each part of the path: the cost
+  does not depend on the size of `T`.
+
+  Returns:
+    The binary SHA1 of the root tree.
+  """
+  for part in reversed(_split_path(path)):
+    binsha = write_tree(repo, [(binsha, TREE_MODE, part)])
+  return binsha
+
+
+def subtree_at(repo, root_binsha, path):
+  """Gets the tree at a relative path.
+
+  Returns:
+    The binary SHA1 of the tree at `path`, or `None` if there is no tree
+    there.
+  """
+  binsha = root_binsha
+  for part in _split_path(path):
+    entry = _find_entry(read_tree(repo, binsha), part)
+    if not entry or entry[1] != TREE_MODE:
+      return None
+    binsha = entry[0]
+  return binsha
+
+
+def splice_tree(repo, root_binsha, path, subtree_binsha):
+  """Replaces the entry at a relative path with a tree.  The trees that
+  lead to `path` are created if necessary.  Only the trees along `path`
+  are rewritten.
+
+  Args:
+    repo: The repo, of type `git.Repo`.
+    root_binsha: The binary SHA1 of the root tree to splice into.
+    path: The relative path, e.g. `foo/bar`.
+    subtree_binsha: The binary SHA1 of the tree to put at `path`, or
+      `None` to remove the entry at `path`.
+  Returns:
+    The binary SHA1 of the new root tree.
+  """
+  parts = _split_path(path)
+  if not parts:
+    return subtree_binsha
+  return _splice(repo, root_binsha, parts, subtree_binsha)
+
+
+def _splice(repo, binsha, parts, subtree_binsha):
+  entries = read_tree(repo, binsha) if binsha else []
+  name = parts[0]
+  existing = _find_entry(entries, name)
+  entries = [entry for entry in entries if entry[2] != name]
+  if len(parts) > 1:
+    child = existing[0] if existing and existing[1] == TREE_MODE else None
+    subtree_binsha = _splice(repo, child, parts[1:], subtree_binsha)
+    if not read_tree(repo, subtree_binsha):
+      # Git does not track empty directories.
+      subtree_binsha = None
+  if subtree_binsha:
+    entries.append((subtree_binsha, TREE_MODE, name))
+  return write_tree(repo, entries)
+
+
+def _find_entry(entries, name):
+  for entry in entries:
+    if entry[2] == name:
+      return entry
+  return None
+
+
+def _split_path(path):
+  return [part for part in path.replace("\\", "/").split("/") if part]
+
+
+def _tree_entry_sort_key(entry):
+  # Git sorts tree entries by name, as if trees had a trailing slash.
+  name = entry[2]
+  if not isinstance(name, bytes):
+    name = name.encode("utf-8")
+  if entry[1] == TREE_MODE:
+    return name + b"/"
+  return name